@@ -16,20 +16,35 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
 # implied.  See the License for the specific language governing
 # permissions and limitations under the License.
-import fnmatch
-import unicodecsv as csv
 import sys
 import os
 import argparse
+import io
+import json
+import time
+import collections
+import multiprocessing
 from time import (gmtime, strftime)
 import datetime
 from ds_store_parser import ds_store_handler
+from ds_store_parser.ds_store import EntryFilter
+from ds_store_parser.discovery import Discovery
+from ds_store_parser.archive import ArchiveDiscovery, is_archive
+from ds_store_parser.carve import CarveDiscovery
+from ds_store_parser.readahead import ReadAhead
+from ds_store_parser import report, registry
+from ds_store_parser.report import ReportRow
+from ds_store_parser.sinks import TsvSink, JsonLinesSink, SqliteSink
+from ds_store_parser.stats import Stats, CountingFile
+from ds_store_parser.cache import ParseCache, ContentDedup, CachedRecord, DecodeCache
 
 __VERSION__ = "0.2.0"
 
-folder_access_report = None
-other_info_report = None
-all_records_ds_store_report = None
+# Output formats and the sinks that write them
+SINKS = {
+    u'tsv': TsvSink,
+    u'jsonl': JsonLinesSink,
+}
 
 def get_arguments():
     """Get needed options for the cli parser interface"""
@@ -47,7 +62,19 @@ def get_arguments():
         action="store",
         type=commandline_arg,
         required=True,
-        help='The source path to search recursively for .DS_Store files to parse. '
+        help='The source path to search recursively for .DS_Store files to parse, '
+             'or a tar (optionally gzip, bz2 or xz compressed) or zip archive to '
+             'read them from without extracting it. '
+    )
+
+    argument_parser.add_argument(
+        '--carve',
+        dest='carve',
+        action="store_true",
+        default=False,
+        help='Treat the source as a raw disk image or unallocated space dump '
+             'and carve .DS_Store files, and the leaf pages of deleted ones, '
+             'out of it. The image is scanned on as many processes as --jobs.'
     )
     
     argument_parser.add_argument(
@@ -59,30 +86,224 @@ def get_arguments():
         required=True,
         help='The destination folder for generated reports.'
     )
+
+    argument_parser.add_argument(
+        '--mmap',
+        dest='mapped',
+        action="store_true",
+        default=False,
+        help='Memory-map each .DS_Store file instead of reading it block by block.'
+    )
+
+    argument_parser.add_argument(
+        '--no-decode',
+        dest='decode',
+        action="store_false",
+        default=True,
+        help='Do not decode plist, bookmark and other known blobs; report them as hex.'
+    )
+
+    argument_parser.add_argument(
+        '-c',
+        '--codes',
+        dest='codes',
+        action="store",
+        type=commandline_arg,
+        default=None,
+        help='Only report records with these codes, comma separated (e.g. ptbL,ptbN). '
+             'Other records are skipped without being decoded.'
+    )
+
+    argument_parser.add_argument(
+        '-f',
+        '--filename',
+        dest='filename',
+        action="store",
+        type=commandline_arg,
+        default=None,
+        help='Only report records whose filename matches this glob pattern.'
+    )
+
+    argument_parser.add_argument(
+        '-j',
+        '--jobs',
+        dest='jobs',
+        action="store",
+        type=int,
+        default=1,
+        help='Number of worker processes used to parse files. Reports are '
+             'written in the same order as a single process run.'
+    )
+
+    argument_parser.add_argument(
+        '-x',
+        '--exclude',
+        dest='excludes',
+        action="append",
+        type=commandline_arg,
+        default=[],
+        help='Skip directories and files matching this pattern (e.g. /proc '
+             'or *.app). Patterns containing a path separator match the full '
+             'path, others match the name. May be given more than once.'
+    )
+
+    argument_parser.add_argument(
+        '--format',
+        dest='formats',
+        action="append",
+        choices=sorted(SINKS),
+        default=None,
+        help='Report format to write: the TSV reports (default) or JSON Lines '
+             'with structured values. May be given more than once.'
+    )
+
+    argument_parser.add_argument(
+        '--sqlite',
+        dest='sqlite',
+        action="store",
+        type=commandline_arg,
+        default=None,
+        help='Also write all records to this SQLite database, with the '
+             'folder access and miscellaneous info reports as views.'
+    )
+
+    argument_parser.add_argument(
+        '--stats',
+        dest='stats',
+        action="store_true",
+        default=False,
+        help='Time each stage of the run (discovery, parsing, decoding by '
+             'codec, writing) and count files, bytes and records per code. '
+             'The summary is written to DS_Store-Parse_Stats.json.'
+    )
+
+    argument_parser.add_argument(
+        '--progress',
+        dest='progress',
+        action="store",
+        type=float,
+        default=None,
+        help='Print a progress line every this many seconds.'
+    )
+
+    argument_parser.add_argument(
+        '--cache',
+        dest='cache',
+        action="store",
+        type=commandline_arg,
+        default=None,
+        help='Keep the parsed records of each file in this cache database '
+             'and reuse them on later runs while the file is unchanged (same '
+             'device, inode, size and modification time).'
+    )
+
+    argument_parser.add_argument(
+        '--cache-hash',
+        dest='cache_hash',
+        action="store_true",
+        default=False,
+        help='Also require the SHA-1 of a file to match before reusing its '
+             'cached records.'
+    )
+
+    argument_parser.add_argument(
+        '--cache-size',
+        dest='cache_size',
+        action="store",
+        type=int,
+        default=512,
+        help='Size limit of the cache in MB; the entries used longest ago '
+             'are evicted past it. Default 512.'
+    )
+
+    argument_parser.add_argument(
+        '--dedup',
+        dest='dedup',
+        action="store_true",
+        default=False,
+        help='Parse byte-identical .DS_Store files (backups, cloned '
+             'profiles) once and report their records for every copy. Files '
+             'are only hashed when another file has the same size.'
+    )
+
+    argument_parser.add_argument(
+        '--dedup-memory',
+        dest='dedup_memory',
+        action="store",
+        type=int,
+        default=128,
+        help='Memory limit in MB of the records --dedup keeps to report for '
+             'copies; a copy of a file whose records were dropped is parsed '
+             'again. Default 128.'
+    )
+
+    argument_parser.add_argument(
+        '--read-ahead',
+        dest='read_ahead',
+        action="store",
+        type=int,
+        default=0,
+        help='Read whole .DS_Store files into memory ahead of the parser on '
+             'this many threads, so that the latency of network or other slow '
+             'file systems overlaps with parsing. Off by default.'
+    )
+
+    argument_parser.add_argument(
+        '--read-ahead-memory',
+        dest='read_ahead_memory',
+        action="store",
+        type=int,
+        default=64,
+        help='Memory limit in MB of the files read ahead and not yet parsed. '
+             'Default 64.'
+    )
+
+    argument_parser.add_argument(
+        '--decode-cache',
+        dest='decode_cache',
+        action="store",
+        type=int,
+        default=2048,
+        help='Number of decoded plist and bookmark values kept in memory, so '
+             'that blobs recurring byte for byte across folders (Finder '
+             'defaults) are decoded once per process. 0 turns it off. '
+             'Default 2048.'
+    )
+
+    argument_parser.add_argument(
+        '--plugin',
+        dest='plugins',
+        action="append",
+        type=commandline_arg,
+        default=[],
+        help='Import this Python module before parsing, so that it can add '
+             'site-specific codes with ds_store_parser.registry.register(). '
+             'May be given more than once.'
+    )
     return argument_parser
     
 def main():
     arguments = get_arguments()
     options = arguments.parse_args()
-    s_path = []
     s_name = u'*.DS_Store*'
-    global folder_access_report, other_info_report, all_records_ds_store_report
     opts_source = options.source
     opts_out = options.outdir
-    
+    formats = options.formats or [u'tsv']
+
+    # Before any report is opened, so a plugin that fails to load leaves
+    # the reports of an earlier run as they were
     try:
-        folder_access_report = open(
-                os.path.join(opts_out, 'DS_Store-Folder_Access_Report.tsv'),
-                'wb'
-            )
-        other_info_report = open(
-                os.path.join(opts_out, 'DS_Store-Miscellaneous_Info_Report.tsv'),
-                'wb'
-            )
-        all_records_ds_store_report = open(
-                os.path.join(opts_out, 'DS_Store-All_Parsed_Report.tsv'),
-                'wb'
-            )
+        registry.load_plugins(options.plugins)
+    except Exception as exp:
+        print 'Unable to proceed. Error loading plugins. Exceptions: {}'.format(exp)
+        sys.exit(0)
+
+    sinks = []
+    try:
+        for output_format in sorted(set(formats)):
+            sinks.append(SINKS[output_format](opts_out))
+        if options.sqlite:
+            sinks.append(SqliteSink(options.sqlite))
     except Exception as exp:
         print 'Unable to proceed. Error creating reports. Exceptions: {}'.format(exp)
         sys.exit(0)
@@ -90,250 +311,506 @@ def main():
     # Accounting for paths ending with \"
     if opts_source[-1:] == '"':
         opts_source = opts_source[:-1]
-    
-    record_handler = RecordHandler()
 
-    for root, dirnames, filenames in os.walk(opts_source):
-        for filename in fnmatch.filter(filenames, s_name):
-            parse(os.path.join(root, filename), record_handler, opts_source)
-        
-def parse(ds_file, record_handler, source):
+    stats = None
+    if options.stats or options.progress:
+        stats = Stats()
+    install_decode_cache(options.decode_cache, stats)
+    if stats is not None:
+        stats.instrument_codecs()
+    cache = None
+    if options.cache:
+        cache = ParseCache(
+            options.cache,
+            max_bytes=options.cache_size * 1024 * 1024,
+            hash_content=options.cache_hash,
+            version=__VERSION__
+        )
+    dedup = None
+    if options.dedup:
+        dedup = ContentDedup(options.dedup_memory * 1024 * 1024)
+    record_handler = RecordHandler(sinks, stats=stats, cache=cache, dedup=dedup)
+
+    if options.carve:
+        ds_files = CarveDiscovery(opts_source, jobs=options.jobs)
+        # Scanned now, as the scan's pool must not be started from the
+        # thread that feeds the parse pool its tasks
+        ds_files.scan()
+    elif is_archive(opts_source):
+        ds_files = ArchiveDiscovery(opts_source, s_name, options.excludes)
+    else:
+        ds_files = Discovery(opts_source, s_name, options.excludes)
+    if stats is not None:
+        ds_files = stats.timed(u'discovery', ds_files)
+    if options.read_ahead > 0:
+        ds_files = ReadAhead(
+            ds_files, options.read_ahead, options.read_ahead_memory * 1024 * 1024
+        )
+        if stats is not None:
+            # Time spent waiting on files not yet read
+            ds_files = stats.timed(u'read_ahead_wait', ds_files)
+    progress = Progress(stats, options.progress)
+    handler_options = {
+        'mapped': options.mapped,
+        'decode': options.decode,
+    }
+    if options.codes or options.filename:
+        handler_options['entry_filter'] = EntryFilter(
+            codes=options.codes.split(u',') if options.codes else None,
+            pattern=options.filename
+        )
+
+    if options.jobs > 1:
+        # Workers hand back one batch of finished rows per file; imap keeps
+        # the batches in discovery order so the reports match a serial run.
+        cache_options = None
+        if cache is not None:
+            cache_options = (options.cache, options.cache_hash)
+        # The values themselves only go back for sinks that use their
+        # structure, and for the cache, which later runs may replay to them
+        keep_values = cache is not None or any(sink.structured for sink in sinks)
+        pool = multiprocessing.Pool(
+            options.jobs, initializer=init_worker,
+            initargs=(stats is not None, cache_options, options.plugins,
+                      options.decode_cache, keep_values)
+        )
+        try:
+            # Duplicates are not sent to the workers. They wait here, in
+            # discovery order, with a None in place of each file that was.
+            queued = collections.deque()
+            def tasks():
+                for ds_file, stat_result in ds_files:
+                    dedup_key, duplicate = record_handler.dedup_lookup(
+                        ds_file, stat_result
+                    )
+                    if duplicate:
+                        queued.append(parse_file(
+                            record_handler, ds_file, stat_result, opts_source,
+                            handler_options, dedup_key, True
+                        ))
+                        continue
+                    queued.append(None)
+                    yield (ds_file, stat_result, opts_source, handler_options,
+                           dedup_key, False)
+            for result in pool.imap(parse_worker, tasks(), chunksize=8):
+                waiting = queued.popleft()
+                while waiting is not None:
+                    record_handler.finish(waiting, handler_options)
+                    progress.update()
+                    waiting = queued.popleft()
+                record_handler.finish(result)
+                progress.update()
+            for waiting in queued:
+                record_handler.finish(waiting, handler_options)
+                progress.update()
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for ds_file, stat_result in ds_files:
+            parse(ds_file, record_handler, opts_source, stat_result, handler_options)
+            progress.update()
+
+    record_handler.close()
+
+    if options.stats:
+        with open(os.path.join(opts_out, 'DS_Store-Parse_Stats.json'), 'wb') as stats_file:
+            json.dump(stats.as_dict(), stats_file, indent=2)
+    progress.update(force=True)
+
+class Progress(object):
+    """Prints the run's progress every `interval' seconds."""
+    def __init__(self, stats, interval):
+        self.stats = stats
+        self.interval = interval
+        self.last = time.time()
+
+    def update(self, force=False):
+        if not self.interval:
+            return
+        now = time.time()
+        if force or now - self.last >= self.interval:
+            self.last = now
+            print >>sys.stderr, self.stats.progress()
+
+# RecordHandler used to build rows inside a worker process
+worker_record_handler = None
+
+def init_worker(collect_stats=False, cache_options=None, plugins=(),
+                decode_cache=0, keep_values=True):
+    global worker_record_handler
+    # Already loaded when the worker was forked; imported again otherwise
+    registry.load_plugins(plugins)
+    stats = None
+    if collect_stats:
+        stats = Stats()
+    install_decode_cache(decode_cache, stats)
+    if stats is not None:
+        stats.instrument_codecs()
+    cache = None
+    if cache_options is not None:
+        # Workers only look files up; the parent stores what they parse
+        cache_path, hash_content = cache_options
+        cache = ParseCache(cache_path, hash_content=hash_content, readonly=True)
+    worker_record_handler = RecordHandler(
+        prerender=True, stats=stats, cache=cache, keep_values=keep_values
+    )
+
+def install_decode_cache(max_entries, stats=None):
+    """Cache decoded plists and bookmarks in this process, counting hits and
+    misses in stats. Installed before the codecs are timed, so their times
+    include the lookups."""
+    if max_entries <= 0:
+        return
+    counters = stats.counters if stats is not None else None
+    DecodeCache(max_entries, counters=counters).install()
+
+def parse_worker(task):
+    result = parse_file(worker_record_handler, *task)
+    stats = worker_record_handler.stats
+    if stats is not None:
+        # Hand back this file's stats only; the parent adds them up
+        result = result._replace(stats=stats.as_dict())
+        stats.reset()
+    return result
+
+def parse(ds_file, record_handler, source, stat_result=None, handler_options=None):
+    if stat_result is None:
+        stat_result = os.stat(ds_file)
+    dedup_key, duplicate = record_handler.dedup_lookup(ds_file, stat_result)
+    record_handler.finish(parse_file(
+        record_handler, ds_file, stat_result, source, handler_options,
+        dedup_key, duplicate
+    ), handler_options)
+
+# The outcome of parsing one file, handed to RecordHandler.finish. A
+# duplicate comes without rows; finish replays those of the file it
+# duplicates, which was finished before it.
+ParseResult = collections.namedtuple('ParseResult', (
+    'ds_file', 'stat_result', 'source', 'rows', 'error', 'stats',
+    'cache_key', 'cache_hit', 'dedup_key', 'duplicate'
+))
+
+def parse_file(record_handler, ds_file, stat_result, source, handler_options=None,
+               dedup_key=None, duplicate=False):
+    """parse_rows, unless the file duplicates an earlier one, or its rows
+    can be replayed from record_handler.cache.
+
+    Returns a ParseResult.
+    """
+    if stat_result is None:
+        stat_result = os.stat(ds_file)
+    if duplicate:
+        return ParseResult(
+            ds_file, stat_result, source, None, None, None,
+            None, False, dedup_key, True
+        )
+
+    cache = record_handler.cache
+    cache_key = None
+    records = None
+    if cache is not None:
+        cache_key = cache.key(ds_file, stat_result, handler_options)
+        records = cache.get(cache_key)
+        if record_handler.stats is not None:
+            record_handler.stats.count(u'cache_hits' if records is not None else u'cache_misses')
+
+    if records is None:
+        rows, error = parse_rows(ds_file, record_handler, source, stat_result, handler_options)
+    else:
+        rows = replay_rows(record_handler, records, ds_file, source, stat_result)
+        error = None
+
+    return ParseResult(
+        ds_file, None, source, rows, error, None,
+        cache_key, records is not None, dedup_key, False
+    )
+
+def replay_rows(record_handler, records, ds_file, source, stat_result=None):
+    """Build the rows of a file from records kept from an earlier parse."""
+    context = FileContext(ds_file, source, stat_result)
+    build_row = record_handler.build_row
+    return [build_row(CachedRecord(record), context) for record in records]
+
+def parse_rows(ds_file, record_handler, source, stat_result=None, handler_options=None):
+    """Parse one .DS_Store file into report rows.
+
+    stat_result is the file's stat taken during discovery; the file is
+    only stat'ed here when it is not supplied. handler_options are passed
+    on to DsStoreHandler.
+
+    Returns a (rows, error) tuple; error is None when the whole file parsed.
+    """
+    if record_handler.stats is not None:
+        return _parse_rows_stats(
+            ds_file, record_handler, source, stat_result, handler_options
+        )
+
     # script will update accessed ts for write access volume in macOS
     # when it reads contents of the file
     ds_handler = None
-    source_acc_time = os.stat(ds_file).st_atime
-    source_acc_time = str(datetime.datetime.utcfromtimestamp(source_acc_time))
-    source_mod_time = os.stat(ds_file).st_mtime
-    source_mod_time = unicode(datetime.datetime.utcfromtimestamp(source_mod_time))
+    rows = []
+    error = None
+    context = FileContext(ds_file, source, stat_result)
+    file_io = None
+
+    try:
+        file_io = open_source(ds_file, context.stat_result)
+        ds_handler = ds_store_handler.DsStoreHandler(
+            file_io, 
+            ds_file,
+            **(handler_options or {})
+        )
+        build_row = record_handler.build_row
+        for record in ds_handler:
+            rows.append(build_row(record, context))
+    # When handler cannot parse ds, report the exception with the file
+    except Exception as exp:
+        error = '{}'.format(exp)
+    finally:
+        if file_io is not None:
+            file_io.close()
+
+    return rows, error
+
+def open_source(ds_file, stat_result):
+    """Open a file to parse; archive members are read from their data."""
+    data = getattr(stat_result, 'data', None)
+    if data is not None:
+        return io.BytesIO(data)
+    return open(ds_file, "rb")
+
+def utc_time(timestamp):
+    """Format a timestamp for the reports; times an archive does not
+    record are None and left blank."""
+    if timestamp is None:
+        return u''
+    return unicode(datetime.datetime.utcfromtimestamp(timestamp))
+
+def source_times(stat_result):
+    """Return the (birth, mod, chg, acc) time strings for the reports."""
+    source_acc_time = stat_result.st_atime
+    source_acc_time = utc_time(source_acc_time)
+    source_mod_time = stat_result.st_mtime
+    source_mod_time = utc_time(source_mod_time)
     try:
         # Account for parsing within Mac
-        source_birth_time = os.stat(ds_file).st_birthtime
-        source_birth_time = unicode(datetime.datetime.utcfromtimestamp(source_birth_time))
-        source_chg_time = os.stat(ds_file).st_ctime
-        source_chg_time = unicode(datetime.datetime.utcfromtimestamp(source_chg_time)) + '[UTC]'
+        source_birth_time = stat_result.st_birthtime
+        source_birth_time = utc_time(source_birth_time)
+        source_chg_time = stat_result.st_ctime
+        source_chg_time = utc_time(source_chg_time) + '[UTC]'
     except:
         # when birthtime not available
-        source_birth_time = os.stat(ds_file).st_ctime
-        source_birth_time = unicode(datetime.datetime.utcfromtimestamp(source_birth_time))
+        source_birth_time = stat_result.st_ctime
+        source_birth_time = utc_time(source_birth_time)
         source_chg_time = ''
 
-    source_size = os.stat(ds_file).st_size
-    file_io = open(ds_file, "rb")
-    
+    return source_birth_time, source_mod_time, source_chg_time, source_acc_time
+
+# Leading characters that make os.path.join start over from the filename
+_ROOTS = tuple(sep for sep in (os.sep, os.altsep) if sep)
+
+class FileContext(object):
+    """What every row of one file shares, worked out once from one stat:
+    the file's path, the prefix of its record paths, its size and its
+    formatted times. The file is only stat'ed when stat_result is not
+    given."""
+    __slots__ = ('ds_file', 'stat_result', 'directory', 'prefix', 'size',
+                 'mod_time', 'chg_time', 'birth_time', 'acc_time')
+
+    def __init__(self, ds_file, source, stat_result=None):
+        if stat_result is None:
+            stat_result = os.stat(ds_file)
+        self.ds_file = ds_file
+        self.stat_result = stat_result
+        # The file's directory relative to the source's parent
+        abs_path_len = len(os.path.split(source)[0])
+        self.directory = os.path.split(ds_file)[0][abs_path_len:]
+        self.prefix = os.path.join(self.directory, u'').replace('\\','/')
+        self.prefix = self.prefix.replace('\r','').replace('\n','')
+        self.size = stat_result.st_size
+
+        birth, mod, chg, acc = source_times(stat_result)
+        self.mod_time = mod + ' [UTC]' if mod else u''
+        self.chg_time = chg
+        self.birth_time = birth + ' [UTC]' if birth else u''
+        self.acc_time = acc + ' [UTC]' if acc else u''
+
+    def record_path(self, filename):
+        """Return the path reported for a record of the file; filename has
+        its line breaks removed already."""
+        if filename[:1] in _ROOTS or u':' in filename:
+            # Not simply appended by os.path.join
+            record_path = os.path.join(self.directory, filename).replace('\\','/')
+            record_path = record_path.replace('\r','').replace('\n','')
+        else:
+            record_path = self.prefix + filename.replace('\\','/')
+        if record_path[:1] != '/':
+            record_path = '/' + record_path
+        return record_path
+
+def _parse_rows_stats(ds_file, record_handler, source, stat_result, handler_options):
+    """parse_rows, timing each stage into record_handler.stats."""
+    stats = record_handler.stats
+    handler_options = handler_options or {}
+    rows = []
+    error = None
+
+    with stats.timer(u'stat'):
+        context = FileContext(ds_file, source, stat_result)
+        stat_result = context.stat_result
+
+    file_io = None
     try:
-        ds_handler = ds_store_handler.DsStoreHandler(
-            file_io, 
-            ds_file
-        )
-    # When handler cannot parse ds, print exception as row
-    except Exception as exp:
-        print 'ERROR: {} for file {}'.format(
-            exp,
-            ds_file.encode('utf-8', errors='replace')
-            )
-            
-    if ds_handler:
-        for record in ds_handler:
-            record_handler.write_record(
-                record, 
-                ds_file, 
-                source,
-                source_birth_time,
-                source_mod_time,
-                source_chg_time,
-                source_acc_time
+        file_io = CountingFile(open_source(ds_file, stat_result))
+        with stats.timer(u'allocator'):
+            ds_handler = ds_store_handler.DsStoreHandler(
+                file_io,
+                ds_file,
+                **handler_options
             )
+        build_row = record_handler.build_row
+        for record in stats.timed(u'traverse', ds_handler):
+            with stats.timer(u'as_dict'):
+                rows.append(build_row(record, context))
+    except Exception as exp:
+        error = '{}'.format(exp)
+    finally:
+        if file_io is not None:
+            file_io.close()
+
+    if file_io is None:
+        # The file could not be opened
+        return rows, error
+    if handler_options.get('mapped'):
+        stats.count(u'bytes_read', stat_result.st_size)
+    else:
+        stats.count(u'bytes_read', file_io.bytes_read)
+    return rows, error
             
 def commandline_arg(bytestring):
     unicode_string = bytestring.decode(sys.getfilesystemencoding())
     return unicode_string
 
 class RecordHandler(object):
-    def __init__(self):
-        global folder_access_report, other_info_report, all_records_ds_store_report
-        fields = [
-            u"ds_store_path_and_record_filename", 
-            u"filename", 
-            u"value", 
-            u"type", 
-            u"code", 
-            u"source_size",
-            u"source_mod_time",
-            u"source_chg_time",
-            u"source_create_time",
-            u"source_acc_time",
-            u"source_file"]
-            
-        # Codes that do not always mean that a folder was opened
-        # Some codes are for informational purposes and may indicate
-        # the parent was opened not the path reported
-        self.other_info_codes = [
-            u"Iloc",
-            u"dilc",
-            u"cmmt",
-            u"extn",
-            u"logS",
-            u"lg1S",
-            u"modD",
-            u"moDD",
-            u"phyS",
-            u"ph1S",
-            u"ptbL",
-            u"ptbN"
-        ]
-        
-        # Codes that indicate the finder window changed for an open folder
-        # or the folders were opened.
-        self.folder_interactions = [
-            u"dscl",
-            u"fdsc",
-            u"vSrn",
-            u"BKGD",
-            u"ICVO",
-            u"LSVO",
-            u"bwsp",
-            u"fwi0",
-            u"fwsw",
-            u"fwvh",
-            u"glvp",
-            u"GRP0",
-            u"icgo",
-            u"icsp",
-            u"icvo",
-            u"icvp",
-            u"icvt",
-            u"info",
-            u"lssp",
-            u"lsvC",
-            u"lsvo",
-            u"lsvt",
-            u"lsvp",
-            u"lsvP",
-            u"pict",
-            u"bRsV",
-            u"pBBk",
-            u"vstl"
-        ]
-            
-            
-        self.fa_writer = csv.DictWriter(
-            all_records_ds_store_report, delimiter="\t", lineterminator="\n",
-            fieldnames=fields
-        )
-        self.fa_writer.writeheader()
-        
-        self.fc_writer = csv.DictWriter(
-            folder_access_report, delimiter="\t", lineterminator="\n",
-            fieldnames=fields
-        )
-        self.fc_writer.writeheader()
-        
-        self.oi_writer = csv.DictWriter(
-            other_info_report, delimiter="\t", lineterminator="\n",
-            fieldnames=fields
-        )
-        self.oi_writer.writeheader()
+    """Builds report rows from records and hands them to the output sinks.
 
-    def write_record(self, record, ds_file, source, source_birth_time, source_mod_time, source_chg_time, source_acc_time):
-        record_dict = record.as_dict()
-        
-        record_dict["source_file"] = ds_file
-        code = record_dict["code"]
-        abs_path_len = len(os.path.split(source)[0])
-        
-        record_dict["filename"] = record_dict["filename"].replace('\x0d','').replace('\x0a','')
-        
-        record_dict["filename"] = record_dict["filename"].replace('\r','').replace('\n','')
-        record_dict["ds_store_path_and_record_filename"] = os.path.join(os.path.split(ds_file)[0][abs_path_len:], record_dict["filename"]).replace('\\','/')
-        record_dict["ds_store_path_and_record_filename"] = record_dict["ds_store_path_and_record_filename"].replace('\r','').replace('\n','')
-        
-        if record_dict["ds_store_path_and_record_filename"][:1] != '/':
-            record_dict["ds_store_path_and_record_filename"] = '/' + record_dict["ds_store_path_and_record_filename"]
-
-        if record_dict["code"] == "vstl":
-            record_dict["value"] = unicode(self.style_handler(record_dict))
-
-        record_dict["source_chg_time"] = source_chg_time
-        record_dict["source_acc_time"] = source_acc_time + ' [UTC]'
-        record_dict["source_mod_time"] = source_mod_time + ' [UTC]'
-        record_dict["source_create_time"] = source_birth_time + ' [UTC]'
-        record_dict["source_size"] = os.stat(ds_file).st_size
-        record_dict["value"] = unicode(self.update_descriptor(record_dict)) + str(record_dict["value"])
-        
-        self.fa_writer.writerow(record_dict)
-        
-        if code in self.other_info_codes:
-            self.oi_writer.writerow(record_dict)
-        elif code in self.folder_interactions:
-            self.fc_writer.writerow(record_dict)
-        else:
-            print 'Code not accounted for.', code
-        
-    def update_descriptor(self, record):
-        types_dict = {
-            "BKGD": u"Finder Folder Background Picture Changed: ",
-            "ICVO": u"ICVO. Unknown. Icon View Options?: ",
-            "Iloc": u"Icon Location or Index Changed: ",
-            "LSVO": u"LSVO. Unknown. List View Options? Changed: ",
-            "bwsp": u"Finder Window Work Space Changed",
-            "cmmt": u"Spotlight Comments Changed: ",
-            "dilc": u"Desktop Icon Location Changed: ",
-            "dscl": u"Is Directory Expanded in List View: ",
-            "fdsc": u"Is Directory Expanded in Limited Finder Window: ",
-            "extn": u"File Extension: ",
-            "fwi0": u"Finder Window Information Changed: ",
-            "fwsw": u"Finder window sidebar widt changed: ",
-            "fwvh": u"Finder window sidebar height changed: ",
-            "glvp": u"Gallery View Properties Changed: ",
-            "GRP0": u"Group by Changed. Group Items by: ",
-            "icgo": u"icgo. Unknown. Icon View?: ",
-            "icsp": u"icsp. Unknown. Icom View?: ",
-            "icvo": u"Icon View Options Changed: ",
-            "icvp": u"Icon View Properties Changed: ",
-            "icvt": u"Icon View Text Changed: ",
-            "info": u"info: Unknown. Finder Info?:",
-            "logS": u"Logical size gathered: ",
-            "lg1S": u"Logical size gathered: ",
-            "lssp": u"lssp. Unknown. List view scroll position changed?: ",
-            "lsvC": u"List View Columns Changed: ",
-            "lsvo": u"List View Options Changed: ",
-            "lsvt": u"List View Text Size Changed: ",
-            "lsvp": u"List View Properties Changed: ",
-            "lsvP": u"List View Properties Changed: ",
-            "modD": u"Modified date gathered: ",
-            "moDD": u"Modified date gathered: ",
-            "phyS": u"Physical size gathered: ",
-            "ph1S": u"Physical size gathered: ",
-            "pict": u"pict. Unknown. Background image changed?: ",
-            "vSrn": u"Opened Folder in new tab: ",
-            "bRsV": u"Browse in Selected View: ",
-            "pBBk": u"Finder Folder Background Image Bookmark Changed: ",
-            "vstl": u"View Style Changed: ",
-            "ptbL": u"Originally sent to Trash. Trash Put Back Location: ",
-            "ptbN": u"Originally sent to Trash. Trash Put Back Name: "
-            }
-        try:
-            code_desc = unicode(types_dict[record["code"]])
-        except:
-            code_desc = u"Unknown Code: {0}".format(record["code"])
-        return code_desc
-            
-    def style_handler(self, record):
-        styles_dict = {
-            '\x00\x00\x00\x00': u"view type null",
-            "none": u"View Type Unselected",
-            "icnv": u"icnv: Icon View",
-            "clmv": u"clmv: Column View",
-            "Nlsv": u"Nlsv: List View Applied",
-            "glyv": u"glyv: Gallery View",
-            "Flwv": u"Flwv: CoverFlow View"
-            }
-
-        try: 
-            code_desc = styles_dict[record["value"]]
-        except:
-            code_desc = "Unknown Code: {0}".format(record["value"])
-        return code_desc
+    With prerender, row values are rendered to their report text as rows
+    are built (see report.RenderedValue); without keep_values, the text
+    is all that is kept. Workers build rows this way to hand back no more
+    than the sinks use.
+    """
+    def __init__(self, sinks=(), prerender=False, stats=None, cache=None, dedup=None,
+                 keep_values=True):
+        self.sinks = list(sinks)
+        self.prerender = prerender
+        self.keep_values = keep_values
+        self.stats = stats
+        self.cache = cache
+        self.dedup = dedup
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+        if self.cache is not None:
+            self.cache.close()
+
+    def dedup_lookup(self, ds_file, stat_result=None):
+        """Return the (dedup_key, duplicate) of a file; duplicate is True
+        when it is identical to a file seen before."""
+        if self.dedup is None:
+            return None, False
+        if stat_result is None:
+            stat_result = os.stat(ds_file)
+        return self.dedup.key(ds_file, stat_result)
+
+    def finish(self, result, handler_options=None):
+        """Keep what a ParseResult adds to the stats, cache and dedup
+        records, then write its rows. A duplicate whose original's records
+        were dropped is parsed here, with handler_options."""
+        if result.stats is not None:
+            self.stats.merge(result.stats)
+        stored = None
+        if result.duplicate:
+            stored = self.dedup.take(result.dedup_key)
+            if stored is None:
+                result = parse_file(
+                    self, result.ds_file, result.stat_result, result.source,
+                    handler_options
+                )
+        rows = result.rows
+        error = result.error
+        if stored is not None:
+            records, error = stored
+            rows = replay_rows(
+                self, records, result.ds_file, result.source, result.stat_result
+            )
+            if self.stats is not None:
+                self.stats.count(u'files_deduplicated')
+        elif result.dedup_key is not None:
+            self.dedup.put(result.dedup_key, rows, error)
+        if result.cache_key is not None:
+            if result.cache_hit:
+                self.cache.touch(result.cache_key)
+            elif error is None:
+                self.cache.put(result.cache_key, rows)
+        self.write_batch(result.ds_file, rows, error)
+
+    def write_record(self, record, context):
+        self.write_rows([self.build_row(record, context)])
+
+    def write_batch(self, ds_file, rows, error):
+        """Write the rows parsed from one file, reporting its error if any."""
+        if error is not None:
+            print 'ERROR: {} for file {}'.format(
+                error,
+                ds_file.encode('utf-8', errors='replace')
+                )
+        if self.stats is not None:
+            self.stats.count(u'files_failed' if error is not None else u'files_parsed')
+        self.write_rows(rows)
+
+    def write_rows(self, rows):
+        stats = self.stats
+        for row in rows:
+            if report.category(row.code) is None:
+                print 'Code not accounted for.', row.code
+            if stats is not None:
+                stats.count_code(row.code)
+        if stats is None:
+            for sink in self.sinks:
+                sink.write_rows(rows)
+            return
+        stats.count(u'records', len(rows))
+        for sink in self.sinks:
+            with stats.timer(u'write:' + type(sink).__name__):
+                sink.write_rows(rows)
+
+    def build_row(self, record, context):
+        """Enrich a record with the details of its source file, from the
+        file's FileContext.
+
+        Returns a ReportRow. Its value is left structured; sinks render it.
+        """
+        filename, record_type, code, value = record.as_tuple()
+        filename = filename.replace('\r','').replace('\n','')
+
+        if self.prerender:
+            value = report.rendered(code, value, self.keep_values)
+
+        return ReportRow(
+            context.record_path(filename),
+            filename,
+            value,
+            record_type,
+            code,
+            context.size,
+            context.mod_time,
+            context.chg_time,
+            context.birth_time,
+            context.acc_time,
+            context.ds_file
+        )
 
 if __name__ == '__main__':
     main()
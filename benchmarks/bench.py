@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks for the parser, run against synthetic stores.
+
+Each stage is timed in a fresh interpreter so that its peak RSS is its
+own:
+
+  allocator     open the buddy allocator and read every block
+  traverse      walk the B-tree (DSStore._traverse), values left undecoded
+  as_dict       DsStoreRecord.as_dict for every record, decoding values
+  batches       RecordBatch.from_entries over every record, decoding values
+  write_record  RecordHandler.write_record into the TSV reports
+  cli           DSStoreParser end to end
+
+Usage::
+
+  python benchmarks/bench.py -o results.json
+  python benchmarks/bench.py --sizes 10,1000,1000000 -o results.json
+  python benchmarks/bench.py -o new.json --compare results.json
+
+Corpora are generated once into the work directory and reused.
+"""
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import csv
+import platform
+import tempfile
+import resource
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+import synth
+
+STORE_STAGES = ('allocator', 'traverse', 'as_dict', 'batches', 'write_record',
+                'cli')
+TREE_STAGES = ('cli',)
+
+DEFAULT_SIZES = (10, 1000, 10000, 100000)
+# depth, fanout, records per store
+DEFAULT_TREE = (4, 6, 40)
+
+
+def peak_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+
+def run_stage(stage, path):
+    """Run one stage against ``path`` in this process. Returns the number
+    of records handled and the elapsed seconds."""
+    from ds_store_parser.ds_store import buddy, DSStore
+    from ds_store_parser import ds_store_handler, registry
+
+    if stage == 'allocator':
+        start = time.time()
+        with open(path, 'rb') as fh:
+            allocator = buddy.Allocator(fh)
+            for number in range(len(allocator._offsets)):
+                block = allocator.get_block(number)
+                if block is not None:
+                    block.read(len(block))
+            records = DSStore(allocator)._records
+        return records, time.time() - start
+
+    if stage == 'traverse':
+        start = time.time()
+        with open(path, 'rb') as fh:
+            records = sum(1 for e in DSStore.open(fh, 'rb', codecs=registry.CODECS))
+        return records, time.time() - start
+
+    if stage == 'as_dict':
+        with open(path, 'rb') as fh:
+            entries = list(DSStore.open(fh, 'rb', codecs=registry.CODECS))
+        start = time.time()
+        for entry in entries:
+            ds_store_handler.DsStoreRecord(entry).as_dict()
+        return len(entries), time.time() - start
+
+    if stage == 'batches':
+        from ds_store_parser.columnar import RecordBatch
+        with open(path, 'rb') as fh:
+            entries = list(DSStore.open(fh, 'rb', codecs=registry.CODECS))
+        start = time.time()
+        for n in range(0, len(entries), 65536):
+            RecordBatch.from_entries(entries[n:n + 65536])
+        return len(entries), time.time() - start
+
+    if stage == 'write_record':
+        import DSStoreParser
+        from ds_store_parser.sinks import TsvSink
+        with open(path, 'rb') as fh:
+            records = list(ds_store_handler.DsStoreHandler(fh, path))
+        outdir = tempfile.mkdtemp()
+        try:
+            handler = DSStoreParser.RecordHandler([TsvSink(outdir)])
+            context = DSStoreParser.FileContext(path, os.path.dirname(path))
+            start = time.time()
+            for record in records:
+                handler.write_record(record, context)
+            handler.close()
+            elapsed = time.time() - start
+        finally:
+            shutil.rmtree(outdir)
+        return len(records), elapsed
+
+    if stage == 'cli':
+        import DSStoreParser
+        outdir = tempfile.mkdtemp()
+        source = path if os.path.isdir(path) else os.path.dirname(path)
+        argv = sys.argv
+        stdout = sys.stdout
+        sys.argv = ['DSStoreParser.py', '-s', source, '-o', outdir]
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            start = time.time()
+            DSStoreParser.main()
+            elapsed = time.time() - start
+            with open(os.path.join(outdir, 'DS_Store-All_Parsed_Report.tsv'), 'rb') as fh:
+                records = sum(1 for row in csv.reader(fh, delimiter='\t')) - 1
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+            sys.argv = argv
+            shutil.rmtree(outdir)
+        return records, elapsed
+
+    raise ValueError('Unknown stage %s' % stage)
+
+
+def measure(stage, path):
+    """Run a stage in a child interpreter and return its measurements."""
+    output = subprocess.check_output([
+        sys.executable, os.path.abspath(__file__), '--stage', stage, path
+    ])
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def build_corpora(workdir, sizes, tree):
+    """Generate the corpora missing from ``workdir``. Returns a list of
+    (name, path, stages)."""
+    corpora = []
+    for size in sizes:
+        directory = os.path.join(workdir, 'store-%d' % size)
+        path = os.path.join(directory, '.DS_Store')
+        if not os.path.exists(path):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            synth.write_store(path, size)
+        corpora.append(('store-%d' % size, path, STORE_STAGES))
+
+    depth, fanout, records = tree
+    name = 'tree-%dx%dx%d' % tree
+    path = os.path.join(workdir, name)
+    if not os.path.isdir(path):
+        synth.make_tree(path, depth, fanout, records)
+    corpora.append((name, path, TREE_STAGES))
+    return corpora
+
+
+def compare(results, baseline, threshold):
+    """Print the change in records/sec against a baseline. Returns the
+    number of cases that got slower by more than ``threshold`` percent."""
+    old = dict(
+        ((r['corpus'], r['stage']), r) for r in baseline['results']
+    )
+    regressions = 0
+    print('%-22s %-13s %12s %12s %8s' % (
+        'corpus', 'stage', 'baseline/s', 'records/s', 'change'))
+    for r in results['results']:
+        before = old.get((r['corpus'], r['stage']))
+        if before is None or not before['records_per_sec']:
+            continue
+        change = 100.0 * (r['records_per_sec'] / before['records_per_sec'] - 1)
+        flag = ''
+        if change < -threshold:
+            regressions += 1
+            flag = '  SLOWER'
+        print('%-22s %-13s %12.0f %12.0f %+7.1f%%%s' % (
+            r['corpus'], r['stage'], before['records_per_sec'],
+            r['records_per_sec'], change, flag))
+    return regressions
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=__doc__
+    )
+    parser.add_argument('--stage', help=argparse.SUPPRESS)
+    parser.add_argument('path', nargs='?', help=argparse.SUPPRESS)
+    parser.add_argument(
+        '--sizes',
+        default=','.join(str(s) for s in DEFAULT_SIZES),
+        help='Comma separated record counts of the single store corpora.'
+    )
+    parser.add_argument(
+        '--tree',
+        default='%d,%d,%d' % DEFAULT_TREE,
+        help='Depth, fanout and records per store of the directory tree '
+             'corpus.'
+    )
+    parser.add_argument(
+        '--stages',
+        default=','.join(STORE_STAGES),
+        help='Comma separated stages to run.'
+    )
+    parser.add_argument(
+        '-w', '--workdir',
+        default=os.path.join(tempfile.gettempdir(), 'ds_store_bench'),
+        help='Where the corpora are generated and kept between runs.'
+    )
+    parser.add_argument(
+        '-r', '--repeat',
+        type=int,
+        default=3,
+        help='Runs of each stage; the fastest is kept.'
+    )
+    parser.add_argument('-o', '--output', help='Write the results to this JSON file.')
+    parser.add_argument('--compare', help='Baseline JSON file to compare against.')
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=10.0,
+        help='Percent slowdown against the baseline reported as a '
+             'regression (exit status 1).'
+    )
+    return parser
+
+
+def main():
+    options = get_arguments().parse_args()
+
+    if options.stage:
+        records, elapsed = run_stage(options.stage, options.path)
+        print(json.dumps({
+            'records': records,
+            'seconds': elapsed,
+            'peak_rss_kb': peak_rss_kb(),
+        }))
+        return 0
+
+    sizes = [int(s) for s in options.sizes.split(',') if s]
+    tree = tuple(int(s) for s in options.tree.split(','))
+    stages = options.stages.split(',')
+
+    corpora = build_corpora(options.workdir, sizes, tree)
+    results = []
+    for name, path, corpus_stages in corpora:
+        for stage in corpus_stages:
+            if stage not in stages:
+                continue
+            runs = [measure(stage, path) for n in range(options.repeat)]
+            best = min(runs, key=lambda r: r['seconds'])
+            result = {
+                'corpus': name,
+                'stage': stage,
+                'records': best['records'],
+                'seconds': round(best['seconds'], 6),
+                'records_per_sec': round(
+                    best['records'] / best['seconds'], 1) if best['seconds'] else 0,
+                'peak_rss_kb': max(r['peak_rss_kb'] for r in runs),
+            }
+            results.append(result)
+            print('%-22s %-13s %9d records %10.0f/s %8d KB' % (
+                name, stage, result['records'], result['records_per_sec'],
+                result['peak_rss_kb']))
+
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'results': results,
+    }
+    if options.output:
+        with open(options.output, 'w') as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as fh:
+            baseline = json.load(fh)
+        if compare(results, baseline, options.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
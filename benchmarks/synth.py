@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""Synthetic .DS_Store files of a controlled shape for the benchmarks.
+
+build_store() writes a list of entries with DSStore.from_entries.
+make_entries() produces a repeatable mix of the record types the parser
+spends its time on, and make_tree() a directory tree holding many small
+stores.
+"""
+from __future__ import print_function
+from __future__ import division
+
+import io
+import os
+import random
+import struct
+
+import biplist
+from mac_alias import bookmark
+
+from ds_store_parser.ds_store import DSStore, DSStoreEntry
+
+PAGE_SIZE = 4096
+
+# Records written for each synthetic filename, in key order
+RECORD_KINDS = (u'Iloc', u'icvp', u'moDD', u'pBBk')
+
+
+def build_store(entries, page_size=PAGE_SIZE):
+    """Return the bytes of a .DS_Store holding ``entries``, a list of
+    (filename, code, typecode, value) tuples."""
+    entries = sorted(
+        (DSStoreEntry(*e) for e in entries), key=lambda e: e.key
+    )
+    f = io.BytesIO()
+    DSStore.from_entries(f, entries, page_size)
+    return f.getvalue()
+
+
+def _bookmark(rng):
+    path = [u'Users', u'analyst', u'Pictures', u'bg%04d.png' % rng.randint(0, 9999)]
+    return bookmark.Bookmark(tocs=[(1, {
+        bookmark.kBookmarkPath: path,
+        bookmark.kBookmarkCNIDPath: [rng.randint(1, 1 << 20) for p in path],
+        bookmark.kBookmarkVolumePath: u'/',
+        bookmark.kBookmarkVolumeIsRoot: True,
+        bookmark.kBookmarkVolumeName: u'Macintosh HD',
+    })]).to_bytes()
+
+
+def make_entries(count, seed=0):
+    """Return ``count`` entries cycling through Iloc, icvp (plist), moDD
+    (dutc) and pBBk (bookmark) records, one of each per filename."""
+    rng = random.Random(seed)
+    entries = []
+    n = 0
+    while len(entries) < count:
+        filename = u'file%07d' % n
+        n += 1
+        for code in RECORD_KINDS:
+            if len(entries) == count:
+                break
+            if code == u'Iloc':
+                value = struct.pack(b'>IIII', rng.randint(0, 2000),
+                                    rng.randint(0, 2000), 0xffffffff,
+                                    0xffff0000)
+                entries.append((filename, code, u'blob', value))
+            elif code == u'icvp':
+                value = biplist.writePlistToString({
+                    'arrangeBy': 'name',
+                    'iconSize': float(rng.choice((16, 32, 64, 128))),
+                    'gridSpacing': 54.0,
+                    'textSize': 12.0,
+                    'showItemInfo': False,
+                    'viewOptionsVersion': 1,
+                })
+                entries.append((filename, code, u'blob', value))
+            elif code == u'moDD':
+                seconds = rng.randint(3000000000, 3700000000)
+                entries.append((filename, code, u'dutc', seconds << 16))
+            else:
+                entries.append((filename, code, u'blob', _bookmark(rng)))
+    return entries
+
+
+def write_store(path, count, seed=0, page_size=PAGE_SIZE):
+    with open(path, 'wb') as fh:
+        fh.write(build_store(make_entries(count, seed), page_size))
+
+
+def make_tree(root, depth, fanout, records_per_store, seed=0):
+    """Write a store holding ``records_per_store`` records into every
+    directory of a tree ``depth`` levels deep with ``fanout`` directories
+    under each. Returns the number of stores written."""
+    data = build_store(make_entries(records_per_store, seed))
+    stores = 0
+    pending = [(root, 0)]
+    while pending:
+        directory, level = pending.pop()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, '.DS_Store'), 'wb') as fh:
+            fh.write(data)
+        stores += 1
+        if level < depth:
+            for n in range(fanout):
+                pending.append((os.path.join(directory, 'dir%02d' % n),
+                                level + 1))
+    return stores
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import os
+import stat
+import struct
+import tarfile
+import zipfile
+import calendar
+from ds_store_parser.discovery import Discovery
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+XZ_MAGIC = b'\xfd7zXZ\x00'
+
+
+class MemberStat(object):
+    """Stands in for os.stat_result for a file read out of an archive.
+
+    The times are those stored in the archive; any it does not record are
+    None. data holds the member's contents.
+    """
+    st_dev = 0
+    st_ino = 0
+    st_mode = stat.S_IFREG | 0o644
+
+    def __init__(self, size, mtime, atime=None, ctime=None, data=None):
+        self.st_size = size
+        self.st_mtime = mtime
+        self.st_atime = atime
+        self.st_ctime = ctime
+        self.data = data
+
+
+def is_archive(path):
+    """Whether path is a tar (plain, gzip, bz2 or xz) or zip archive."""
+    if not os.path.isfile(path):
+        return False
+    if zipfile.is_zipfile(path):
+        return True
+    with open(path, 'rb') as file_io:
+        if file_io.read(len(XZ_MAGIC)) == XZ_MAGIC:
+            return True
+    return tarfile.is_tarfile(path)
+
+
+class ArchiveDiscovery(Discovery):
+    """Find candidate .DS_Store files inside a tar or zip archive.
+
+    Iterating yields (path, MemberStat) tuples, in archive order, with each
+    member's contents in the MemberStat's data. Paths are the archive's
+    path joined with the member's name, as if it had been extracted next
+    to it. Tar archives, compressed or not, are read in a single streaming
+    pass; zip archives from their central directory.
+
+    Exclude patterns are applied to the member and each directory above
+    it, as Discovery applies them while walking.
+    """
+    def __iter__(self):
+        if zipfile.is_zipfile(self.source):
+            return self._zip()
+        return self._tar()
+
+    def _wanted(self, name):
+        name = name.replace(u'\\', u'/').strip(u'/')
+        path = self.source
+        for part in name.split(u'/'):
+            path = os.path.join(path, part)
+            if self._excluded(part, path):
+                return None
+        if not self._match(os.path.normcase(part)):
+            return None
+        return path
+
+    def _tar(self):
+        with open(self.source, 'rb') as file_io:
+            if file_io.read(len(XZ_MAGIC)) == XZ_MAGIC:
+                if lzma is None:
+                    raise IOError('Reading xz archives needs the lzma module')
+                file_io.seek(0)
+                stream = lzma.LZMAFile(file_io)
+                mode = 'r|'
+            else:
+                file_io.seek(0)
+                stream = file_io
+                mode = 'r|*'
+            tar = tarfile.open(fileobj=stream, mode=mode)
+            for member in tar:
+                if not member.isfile():
+                    continue
+                path = self._wanted(_unicode_name(member.name))
+                if path is None:
+                    continue
+                data = tar.extractfile(member).read()
+                headers = member.pax_headers
+                yield path, MemberStat(
+                    member.size,
+                    member.mtime,
+                    _pax_time(headers, u'atime'),
+                    _pax_time(headers, u'ctime'),
+                    data
+                )
+
+    def _zip(self):
+        archive = zipfile.ZipFile(self.source)
+        try:
+            for info in archive.infolist():
+                if info.filename.endswith('/'):
+                    continue
+                path = self._wanted(_unicode_name(info.filename))
+                if path is None:
+                    continue
+                mtime, atime, ctime = _zip_times(info)
+                yield path, MemberStat(
+                    info.file_size, mtime, atime, ctime, archive.read(info)
+                )
+        finally:
+            archive.close()
+
+
+def _unicode_name(name):
+    if isinstance(name, bytes):
+        return name.decode('utf-8', 'replace')
+    return name
+
+
+def _pax_time(headers, name):
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _zip_times(info):
+    """Return the (mtime, atime, ctime) of a zip member.
+
+    The extended timestamp extra field holds UTC times; without it only the
+    DOS modification time is known, which has no time zone and is taken as
+    UTC.
+    """
+    extra = info.extra
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag, size = struct.unpack_from('<HH', extra, pos)
+        if tag == 0x5455 and size >= 5:
+            flags = struct.unpack_from('<B', extra, pos + 4)[0]
+            times = []
+            offset = pos + 5
+            for bit in (1, 2, 4):
+                if flags & bit and offset + 4 <= pos + 4 + size:
+                    times.append(struct.unpack_from('<i', extra, offset)[0])
+                    offset += 4
+                else:
+                    times.append(None)
+            if times[0] is not None:
+                return tuple(times)
+        pos += 4 + size
+    return calendar.timegm(info.date_time + (0, 0, 0)), None, None
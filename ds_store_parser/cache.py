@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+import time
+import zlib
+import pickle
+import sqlite3
+import hashlib
+import threading
+import collections
+from ds_store_parser import report, registry
+from ds_store_parser.decoders import PlistCodec, BookmarkCodec, freeze
+
+# Bump when the parsed records change shape, to drop older entries
+CACHE_FORMAT = 2
+
+
+class ParseCache(object):
+    """Parsed records of .DS_Store files kept between runs.
+
+    Entries are keyed on the file's identity (st_dev, st_ino, st_size and
+    the modification time in nanoseconds), optionally its SHA-1, and the
+    parse options, so a file that has not changed since it was cached is
+    not read again. Each entry holds the file's records as (filename,
+    type, code, value) tuples, with the values already rendered for the
+    reports; rows are rebuilt from them with the file's current stat
+    details. The key also holds registry.fingerprint() as it was when the
+    cache was opened, so records rendered with other plugins loaded are
+    not replayed.
+
+    The cache is a SQLite database and may be shared by successive runs.
+    Its entries are pickled, so only use a cache file you created. When it
+    grows past max_bytes, the entries used longest ago are evicted on
+    close(). Worker processes open it with readonly=True and leave the
+    writes to the parent.
+    """
+    SCHEMA = u"""
+        CREATE TABLE IF NOT EXISTS meta (
+            name TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            data BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            used REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS entries_used ON entries (used);
+    """
+
+    def __init__(self, path, max_bytes=512 * 1024 * 1024, hash_content=False,
+                 version=u"", readonly=False):
+        self.max_bytes = max_bytes
+        self.hash_content = hash_content
+        self.readonly = readonly
+        self.fingerprint = registry.fingerprint()
+        self._used = []
+        self._pending = []
+        self._now = time.time()
+        self._db = sqlite3.connect(path, timeout=60)
+        self._db.text_factory = str
+        if readonly:
+            return
+        self._db.executescript(self.SCHEMA)
+
+        version = u"{0}/{1}".format(CACHE_FORMAT, version)
+        row = self._db.execute(
+            u"SELECT value FROM meta WHERE name = 'version'"
+        ).fetchone()
+        if row is None or row[0] != version:
+            self._db.execute(u"DELETE FROM entries")
+            self._db.execute(
+                u"INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,)
+            )
+            self._db.commit()
+
+    def key(self, ds_file, stat_result, handler_options=None):
+        """Return the cache key of a file for the given parse options."""
+        mtime_ns = getattr(stat_result, 'st_mtime_ns', None)
+        if mtime_ns is None and stat_result.st_mtime is not None:
+            mtime_ns = int(round(stat_result.st_mtime * 1000000000))
+        parts = [
+            stat_result.st_dev,
+            stat_result.st_ino,
+            stat_result.st_size,
+            mtime_ns,
+            self.fingerprint,
+        ]
+        if not stat_result.st_ino:
+            # No file identity (e.g. an archive member): key on the path
+            parts.append(ds_file)
+        if self.hash_content:
+            parts.append(content_digest(ds_file, stat_result))
+        options = handler_options or {}
+        entry_filter = options.get('entry_filter')
+        parts.append(options.get('decode', True))
+        if entry_filter is not None:
+            parts.extend([
+                sorted(entry_filter.codes or []),
+                sorted(entry_filter.types or []),
+                entry_filter.prefix,
+                entry_filter.pattern,
+            ])
+        return repr(parts)
+
+    def get(self, key):
+        """Return the records cached under key, or None."""
+        row = self._db.execute(
+            u"SELECT data FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(zlib.decompress(row[0]))
+
+    def touch(self, key):
+        """Mark an entry as used by this run."""
+        self._used.append((self._now, key))
+
+    def put(self, key, rows):
+        """Store the records of a file, taken from its report rows."""
+        data = zlib.compress(pickle.dumps(row_records(rows), 2))
+        self._pending.append((key, sqlite3.Binary(data), len(data), self._now))
+        if len(self._pending) >= 1000:
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            self._db.executemany(
+                u"INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                self._pending
+            )
+            self._pending = []
+        if self._used:
+            self._db.executemany(
+                u"UPDATE entries SET used = ? WHERE key = ?", self._used
+            )
+            self._used = []
+        self._db.commit()
+
+    def evict(self):
+        """Drop the entries used longest ago until the cache fits in
+        max_bytes."""
+        total = self._db.execute(
+            u"SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in self._db.execute(
+                u"SELECT key, size FROM entries ORDER BY used"):
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        self._db.executemany(u"DELETE FROM entries WHERE key = ?", evicted)
+        self._db.commit()
+        self._db.execute(u"VACUUM")
+
+    def close(self):
+        if not self.readonly:
+            self.flush()
+            self.evict()
+        self._db.close()
+
+
+class ContentDedup(object):
+    """Records of the files parsed in this run, keyed on their content.
+
+    Only files sharing their size with an earlier file are hashed; the
+    first file of each size is keyed on its path until a second one turns
+    up, and is hashed then.
+
+    key() tells whether a file duplicates one seen before. The records of
+    that earlier file are stored with put() once it is parsed, and the
+    duplicate replays them with take(). Files are handed to take() in the
+    order key() saw them, which may be from another thread, as the pool
+    feeds tasks from its own.
+
+    The records kept are limited to max_bytes, counted as the length of
+    their text. Past it, those used longest ago are dropped, those no
+    duplicate waits for first; the records of a file larger than the
+    limit are not kept at all. take() returns None for a duplicate whose
+    records were dropped, and the caller parses it after all; a file
+    seen after its original's records were dropped is not a duplicate.
+    """
+    def __init__(self, max_bytes=128 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._lock = threading.Lock()
+        self._first_of_size = {}
+        self._rekeyed = {}
+        # Keys handed out by key() whose records put() has not stored yet
+        self._pending = set()
+        self._waiting = collections.defaultdict(int)
+        # key: (records, error, size)
+        self._records = collections.OrderedDict()
+
+    def key(self, ds_file, stat_result):
+        """Return (key, duplicate) for a file."""
+        size = stat_result.st_size
+        with self._lock:
+            first = self._first_of_size.get(size)
+            if first is None:
+                self._first_of_size[size] = (ds_file, stat_result)
+                key = (u"path", ds_file)
+                self._pending.add(key)
+                return key, False
+            # A second file of this size: from now on key on content
+            self._first_of_size[size] = True
+
+        # Hashed without holding the lock, which put() and take() need
+        digest = content_digest(ds_file, stat_result)
+        first_digest = None
+        if first is not True:
+            first_digest = content_digest(*first)
+        with self._lock:
+            if first_digest is not None:
+                first_key = (u"path", first[0])
+                if first_key in self._records:
+                    self._records[first_digest] = self._records.pop(first_key)
+                elif first_key in self._pending:
+                    # Still being parsed; put() files it under the digest
+                    self._rekeyed[first_key] = first_digest
+                    self._pending.add(first_digest)
+                # Otherwise its records were dropped already
+            if digest in self._records or digest in self._pending:
+                self._waiting[digest] += 1
+                return digest, True
+            self._pending.add(digest)
+        return digest, False
+
+    def put(self, key, rows, error=None):
+        """Store the records of a file that was not a duplicate."""
+        records = row_records(rows)
+        size = records_size(records, error)
+        with self._lock:
+            self._pending.discard(key)
+            key = self._rekeyed.pop(key, key)
+            self._pending.discard(key)
+            if size > self.max_bytes:
+                return
+            self._records[key] = (records, error, size)
+            self.size += size
+            for waited in (False, True):
+                for old_key in list(self._records):
+                    if self.size <= self.max_bytes:
+                        return
+                    if bool(self._waiting.get(old_key)) is waited:
+                        self.size -= self._records.pop(old_key)[2]
+
+    def take(self, key):
+        """Return the (records, error) of the file a duplicate matched, or
+        None if they were dropped."""
+        with self._lock:
+            self._waiting[key] -= 1
+            if not self._waiting[key]:
+                del self._waiting[key]
+            stored = self._records.pop(key, None)
+            if stored is None:
+                return None
+            self._records[key] = stored
+            return stored[:2]
+
+
+class DecodeCache(object):
+    """Decoded values of blobs that recur byte for byte, such as the
+    plists of the many folders that keep Finder's defaults.
+
+    install() puts the cache in front of the codecs of registry.CODECS,
+    PlistCodec and BookmarkCodec by default, for every store read in this
+    process afterwards. Entries are keyed on the record's code and the
+    SHA-1 of the blob; past max_entries, those used longest ago are
+    evicted. Blobs that fail to decode are not cached.
+
+    The value of a cached blob is shared by every record that has it, so
+    it is cached as a read-only view made by the codec's freeze(), or
+    decoders.freeze() for codecs without one: changing it raises instead
+    of changing the value of later records. The view lists the items of
+    dicts in the same order as the value itself, so records render the
+    same text with the cache as without it.
+
+    Hits, misses and evictions are counted in counters, under
+    "decode_cache_hits", "decode_cache_misses" and
+    "decode_cache_evictions"; pass a Stats' counters to report them with
+    its other counters.
+    """
+    def __init__(self, max_entries=2048, counters=None):
+        self.max_entries = max_entries
+        if counters is None:
+            counters = collections.defaultdict(int)
+        self.counters = counters
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    @property
+    def hits(self):
+        return self.counters[u"decode_cache_hits"]
+
+    @property
+    def misses(self):
+        return self.counters[u"decode_cache_misses"]
+
+    @property
+    def evictions(self):
+        return self.counters[u"decode_cache_evictions"]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def install(self, codecs=(PlistCodec, BookmarkCodec)):
+        """Cache the values of the codes decoded with one of codecs. Codes
+        registered afterwards are not cached."""
+        for code, codec in list(registry.CODECS.items()):
+            # Look through wrappers, e.g. those of an earlier cache or of
+            # Stats.instrument_codecs() inherited by a forked worker
+            while hasattr(codec, 'codec'):
+                codec = codec.codec
+            if codec in codecs:
+                registry.CODECS[code] = _CachedCodec(self, code, codec)
+
+    def uninstall(self):
+        """Take the cache back out of registry.CODECS."""
+        for code, codec in list(registry.CODECS.items()):
+            if isinstance(codec, _CachedCodec) and codec.cache is self:
+                registry.CODECS[code] = codec.codec
+
+    def decode(self, codec, code, data):
+        """Return codec's value of the blob data of a code, from the cache
+        when the same blob was decoded before."""
+        key = (code, hashlib.sha1(data).digest())
+        with self._lock:
+            value = self._entries.pop(key, _MISSING)
+            if value is not _MISSING:
+                self._entries[key] = value
+                self.counters[u"decode_cache_hits"] += 1
+        if value is _MISSING:
+            value = getattr(codec, 'freeze', freeze)(codec.decode(data))
+            with self._lock:
+                self.counters[u"decode_cache_misses"] += 1
+                self._entries[key] = value
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.counters[u"decode_cache_evictions"] += 1
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+_MISSING = object()
+
+
+class _CachedCodec(object):
+    """A codec decoding through a DecodeCache. Keeps the codec's __name__,
+    so records report the same type."""
+    def __init__(self, cache, code, codec):
+        self.cache = cache
+        self.code = code
+        self.codec = codec
+        self.__name__ = codec.__name__
+
+    def decode(self, data):
+        return self.cache.decode(self.codec, self.code, data)
+
+
+def row_records(rows):
+    """Return the records to replay report rows from: (filename, type,
+    code, value) tuples with the values rendered."""
+    return [
+        (row.filename, row.type, row.code, report.rendered(row.code, row.value))
+        for row in rows
+    ]
+
+
+def records_size(records, error=None):
+    """Return the length of the text of records taken by row_records."""
+    size = len(error) if error else 0
+    for filename, record_type, code, value in records:
+        size += len(filename) + len(record_type) + len(code) + len(value)
+    return size
+
+
+class CachedRecord(object):
+    """A record replayed from the cache, in place of a DsStoreRecord.
+    Rebuilding a row from a row's own fields gives the same row."""
+    __slots__ = ("record",)
+
+    def __init__(self, record):
+        self.record = record
+
+    def as_tuple(self):
+        return self.record
+
+
+def content_digest(ds_file, stat_result):
+    """Return the SHA-1 of a file, or of the data of an archive member."""
+    data = getattr(stat_result, 'data', None)
+    if data is not None:
+        return hashlib.sha1(data).hexdigest()
+    return file_digest(ds_file)
+
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file_io:
+        for chunk in iter(lambda: file_io.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import re
+import mmap
+import struct
+import multiprocessing
+from ds_store_parser import registry
+from ds_store_parser.archive import MemberStat
+from ds_store_parser.ds_store import buddy
+from ds_store_parser.ds_store.store import DSStoreEntry
+
+# The start of every .DS_Store file, as buddy.Allocator checks it
+HEADER = b'\x00\x00\x00\x01Bud1'
+# Size of the B-tree pages Finder writes
+PAGE_SIZE = 4096
+# Blocks sit this far into the file, past the magic number
+BLOCK_SKEW = 4
+# The value types of records. They follow the code of every record, so
+# with the Bud1 of the header they anchor the scan.
+VALUE_TYPES = (b'blob', b'bool', b'comp', b'dutc', b'long', b'shor', b'type',
+               b'ustr')
+
+# One pass over the image finds both. A single alternation of literals
+# lets the regex engine skip ahead on their first bytes; a regex of every
+# known code and type pair is several times slower.
+_anchors = re.compile(b'(?:Bud1|' + b'|'.join(VALUE_TYPES) + b')')
+_header = struct.Struct(b'>I4sIII')
+_uint32 = struct.Struct(b'>I')
+_node = struct.Struct(b'>II')
+_printable = re.compile(b'^[\x20-\x7e]{4}$').match
+
+
+class CarveDiscovery(object):
+    """Find .DS_Store files, and B-tree leaf pages of deleted ones, in a
+    raw disk image or a dump of unallocated space.
+
+    Iterating yields (path, MemberStat) tuples in image order, with the
+    carved data in the MemberStat, so they parse as archive members do.
+    A store is found by its header; those whose root block and block
+    offsets are consistent are carved from the header to the end of their
+    last block. A page that is not part of such a store is salvaged when
+    it parses as a leaf: it is wrapped, unchanged, as the only node of a
+    store of its own. Paths are the image's path joined with the hex
+    offset of the store or page, e.g. image.dd/0x2f000.DS_Store or
+    image.dd/0x31004.leaf.DS_Store. Carved files have no times.
+
+    The image is memory-mapped and scanned in chunks of chunk_size bytes,
+    on jobs processes when jobs is above 1, before anything is yielded
+    (see scan). Leaf pages are looked for at offsets 4 past a multiple of
+    alignment, where they sit when the file started on a sector boundary;
+    stores are taken at any offset. Stores larger than max_store_size are
+    not carved.
+    """
+    def __init__(self, source, chunk_size=64 * 1024 * 1024, jobs=1,
+                 leaves=True, alignment=512, max_store_size=16 * 1024 * 1024):
+        self.source = source
+        self.chunk_size = chunk_size
+        self.jobs = jobs
+        self.leaves = leaves
+        self.alignment = alignment
+        self.max_store_size = max_store_size
+        self._hits = None
+
+    def scan(self):
+        """Scan the image, unless that was done already, and return the
+        hits of each chunk, as scan_chunk returns them.
+
+        Iterating scans first. With jobs above 1, call this before starting
+        another process pool: the scan's own pool must not be forked from
+        one of that pool's threads, as iterating from a task generator would.
+        """
+        if self._hits is None:
+            size = os.path.getsize(self.source)
+            tasks = [
+                (self.source, start, min(start + self.chunk_size, size),
+                 self.leaves, self.alignment, self.max_store_size)
+                for start in range(0, size, self.chunk_size)
+            ]
+            if self.jobs > 1 and len(tasks) > 1:
+                pool = multiprocessing.Pool(self.jobs)
+                try:
+                    self._hits = pool.map(scan_chunk, tasks)
+                finally:
+                    pool.terminate()
+            else:
+                self._hits = [scan_chunk(task) for task in tasks]
+        return self._hits
+
+    def __iter__(self):
+        results = self.scan()
+        if not results:
+            return
+
+        with open(self.source, 'rb') as file_io:
+            image = mmap.mmap(file_io.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                # End of what was carved so far. Pages before it belong to
+                # a store, or were found again by the next chunk.
+                covered = 0
+                for hits in results:
+                    for kind, offset, length in hits:
+                        if kind == u'leaf' and offset < covered:
+                            continue
+                        covered = max(covered, offset + length)
+                        # The size reported is that of the bytes carved
+                        data = image[offset:offset + length]
+                        size = len(data)
+                        if kind == u'store':
+                            name = u'0x{0:x}.DS_Store'.format(offset)
+                        else:
+                            data = leaf_store(data)
+                            name = u'0x{0:x}.leaf.DS_Store'.format(offset)
+                        yield (os.path.join(self.source, name),
+                               MemberStat(size, None, data=data))
+            finally:
+                image.close()
+
+
+def scan_chunk(task):
+    """Scan one chunk of an image for stores and leaf pages.
+
+    task is (path, start, end, leaves, alignment, max_store_size). Only
+    anchors starting before end are taken, so chunks that meet share none;
+    what they anchor may run past it. Returns (kind, offset, length)
+    tuples in offset order, kind being u'store' or u'leaf'.
+    """
+    path, start, end, leaves, alignment, max_store_size = task
+    hits = []
+    with open(path, 'rb') as file_io:
+        image = mmap.mmap(file_io.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            known_codes = registry.CODES
+            skip_to = start
+            # Search a little past end for anchors that straddle it
+            stop = min(end + len(HEADER), len(image))
+            for match in _anchors.finditer(image, start, stop):
+                pos = match.start()
+                if pos >= end:
+                    break
+                if pos < skip_to or pos < 4:
+                    continue
+                if match.group() == b'Bud1':
+                    length = store_length(image, pos - 4, max_store_size)
+                    if length:
+                        hits.append((u'store', pos - 4, length))
+                        skip_to = pos - 4 + length
+                elif leaves and image[pos - 4:pos] in known_codes:
+                    page = find_leaf(image, pos, alignment)
+                    if page is not None:
+                        hits.append((u'leaf', page, PAGE_SIZE))
+                        skip_to = page + PAGE_SIZE
+        finally:
+            image.close()
+    return hits
+
+
+def store_length(image, offset, max_size=16 * 1024 * 1024):
+    """Return the length of the store whose header is at offset, or None
+    if there is no consistent header there.
+
+    Besides the checks buddy.Allocator makes, the root block must lie in
+    the image and every block in the root's offset table must be a valid
+    buddy block inside max_size.
+    """
+    if offset < 0 or offset + _header.size > len(image):
+        return None
+    magic1, magic2, root, root_size, root2 = _header.unpack_from(image, offset)
+    if magic1 != 1 or magic2 != b'Bud1' or root != root2:
+        return None
+    if root & 0x1f or root_size < 32 or root + root_size > max_size:
+        return None
+    table = offset + BLOCK_SKEW + root
+    if table + 8 > len(image):
+        return None
+    count = _uint32.unpack_from(image, table)[0]
+    if not count or 8 + 4 * count > root_size or table + 8 + 4 * count > len(image):
+        return None
+    end = root + root_size
+    for addr in struct.unpack_from(b'>%uI' % count, image, table + 8):
+        if not addr:
+            # A slot left by a freed block
+            continue
+        width = addr & 0x1f
+        block_end = (addr & ~0x1f) + (1 << width)
+        if width < 5 or block_end > max_size:
+            return None
+        end = max(end, block_end)
+    return BLOCK_SKEW + end
+
+
+def find_leaf(image, pos, alignment=512):
+    """Return the offset of the leaf page holding the record whose value
+    type is at pos, or None.
+
+    Each aligned offset a page could start at is tried in turn; a page
+    must have no next node, parse as leaf records, all with printable
+    codes, and take in the record at pos.
+    """
+    lowest = max(0, pos + 4 - PAGE_SIZE)
+    first = lowest + (BLOCK_SKEW - lowest) % alignment
+    for page in range(first, pos - 15, alignment):
+        if _parses_as_leaf(image, page, pos):
+            return page
+    return None
+
+
+def _parses_as_leaf(image, page, pos):
+    next_node, count = _node.unpack_from(image, page)
+    if next_node or not count or count > PAGE_SIZE // 13:
+        return False
+    data = image[page:page + PAGE_SIZE]
+    block = _Page(data, _node.size)
+    try:
+        entries = DSStoreEntry.read_records(block, count, decode=False)
+    except (buddy.BuddyError, ValueError, struct.error):
+        # UnicodeDecodeError is a ValueError
+        return False
+    if page + block.pos < pos + 4:
+        return False
+    for entry in entries:
+        if not _printable(entry.code):
+            return False
+    return True
+
+
+def leaf_store(page):
+    """Return a store holding page, unchanged, as its only node."""
+    count = _node.unpack_from(page)[1]
+    superblock = struct.pack(b'>IIIII', 2, 0, count, 1, PAGE_SIZE)
+    file_io = io.BytesIO()
+    buddy.Allocator.create(file_io, [superblock, page], {b'DSDB': 1})
+    return file_io.getvalue()
+
+
+class _Page(object):
+    """A page of an image, read as DSStoreEntry.read_records reads a
+    Block."""
+    def __init__(self, data, pos):
+        self.data = data
+        self.pos = pos
+
+    def buffer(self):
+        return self.data, self.pos
+
+    def seek(self, pos):
+        self.pos = pos
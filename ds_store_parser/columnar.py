@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+import math
+import array
+import binascii
+import datetime
+import collections
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+EPOCH = datetime.datetime(1970, 1, 1)
+# The dutc epoch, in microseconds since 1970
+DUTC_EPOCH_US = -2082844800 * 1000000
+# The last microsecond a datetime can hold, in microseconds since 1970
+_span = datetime.datetime.max - EPOCH
+MAX_US = (_span.days * 86400 + _span.seconds) * 1000000 + _span.microseconds
+MAX_DUTC_SECONDS = (MAX_US - DUTC_EPOCH_US) // 1000000
+
+INTEGER_TYPES = frozenset([b'bool', b'long', b'shor', b'comp'])
+
+COLUMNS = (
+    "filename", "type", "code", "value",
+    "integer", "has_integer", "timestamp", "has_timestamp",
+)
+
+
+class RecordBatch(object):
+    """Records of a store held as columns, one item per record.
+
+    filename, type and code are lists, as DsStoreRecord.as_tuple() gives
+    them. The times of dutc records and of moDD/modD blobs are in
+    timestamp, as microseconds since 1970-01-01 UTC, and bool, long, shor
+    and comp values in integer; has_timestamp and has_integer mark the
+    records they hold. Every other value is in value as as_tuple() gives
+    it, with None where one of the numeric columns holds it. A time out of
+    datetime's range, which as_tuple() fails on, is left in value instead:
+    the integer of a dutc record, or the hex of a blob.
+
+    The numeric columns are numpy arrays when numpy is installed, so that
+    times convert with ``batch.timestamp.astype('datetime64[us]')``;
+    otherwise they are array.array, or lists where the platform has no
+    64-bit array type. columns() hands them all over at once, e.g. to
+    pandas.DataFrame.
+    """
+    __slots__ = COLUMNS
+
+    def __init__(self, filename, type, code, value, integer, has_integer,
+                 timestamp, has_timestamp):
+        self.filename = filename
+        self.type = type
+        self.code = code
+        self.value = value
+        self.integer = integer
+        self.has_integer = has_integer
+        self.timestamp = timestamp
+        self.has_timestamp = has_timestamp
+
+    @classmethod
+    def from_entries(cls, entries):
+        """Build a batch from DSStoreEntry objects. Times are converted all
+        at once rather than record by record."""
+        entries = list(entries)
+        filenames = [entry.filename for entry in entries]
+        codes = [entry.code for entry in entries]
+        types = [entry.type for entry in entries]
+        values = [entry.value for entry in entries]
+        integer_rows = []
+        dutc_rows = []
+        modd_rows = []
+        hexlify = binascii.hexlify
+
+        for row, entry_type in enumerate(types):
+            if not isinstance(entry_type, bytes):
+                # A codec; its value is already decoded
+                types[row] = entry_type.__name__
+            elif entry_type == b'blob':
+                if codes[row].lower() == b'modd':
+                    modd_rows.append(row)
+                else:
+                    values[row] = hexlify(values[row])
+            elif entry_type == b'dutc':
+                dutc_rows.append(row)
+            elif entry_type in INTEGER_TYPES:
+                integer_rows.append(row)
+        integers = [values[row] for row in integer_rows]
+        dutcs = [values[row] for row in dutc_rows]
+        modds = [values[row] for row in modd_rows]
+        for row in integer_rows + dutc_rows + modd_rows:
+            values[row] = None
+
+        count = len(filenames)
+        integer = _column('uint64', count)
+        has_integer = _column('bool', count)
+        timestamp = _column('int64', count)
+        has_timestamp = _column('bool', count)
+
+        _fill(integer, has_integer, integer_rows, integers)
+        times, valid = dutc_times(dutcs)
+        _fill(timestamp, has_timestamp, dutc_rows, times, valid)
+        for n in _invalid(valid):
+            values[dutc_rows[n]] = dutcs[n]
+        times, valid = modd_times(modds)
+        _fill(timestamp, has_timestamp, modd_rows, times, valid)
+        for n in _invalid(valid):
+            values[modd_rows[n]] = hexlify(modds[n])
+
+        return cls(filenames, types, codes, values, integer, has_integer,
+                   timestamp, has_timestamp)
+
+    def __len__(self):
+        return len(self.filename)
+
+    def columns(self):
+        """Return the columns as an OrderedDict, by name."""
+        return collections.OrderedDict(
+            (name, getattr(self, name)) for name in COLUMNS
+        )
+
+    def as_tuples(self):
+        """Return the records as the (filename, type, code, value) tuples
+        DsStoreRecord.as_tuple() gives."""
+        records = []
+        for row in range(len(self.filename)):
+            entry_type = self.type[row]
+            value = self.value[row]
+            if self.has_timestamp[row]:
+                value = to_datetime(self.timestamp[row])
+            elif self.has_integer[row]:
+                value = int(self.integer[row])
+                if entry_type == b'bool':
+                    value = bool(value)
+            records.append(
+                (self.filename[row], entry_type, self.code[row], value)
+            )
+        return records
+
+
+def to_datetime(microseconds):
+    """Return the datetime of a time in a timestamp column."""
+    return EPOCH + datetime.timedelta(microseconds=int(microseconds))
+
+
+def dutc_times(values):
+    """Convert dutc values (1/65536 s since 1904) to microseconds since
+    1970, truncated to the second as as_tuple() does.
+
+    Returns (times, valid); valid is false for times out of datetime's
+    range, whose time is left 0.
+    """
+    if numpy is not None:
+        seconds = numpy.array(values, dtype=numpy.uint64) >> numpy.uint64(16)
+        valid = seconds <= MAX_DUTC_SECONDS
+        times = numpy.where(valid, seconds, 0).astype(numpy.int64) \
+            * 1000000 + DUTC_EPOCH_US
+        return times, valid
+    times = []
+    valid = []
+    for value in values:
+        seconds = value >> 16
+        ok = seconds <= MAX_DUTC_SECONDS
+        times.append(seconds * 1000000 + DUTC_EPOCH_US if ok else 0)
+        valid.append(ok)
+    return times, valid
+
+
+def modd_times(blobs):
+    """Convert moDD/modD blobs to microseconds since 1970.
+
+    Their hex digits, read in reverse, are nanoseconds since 1970; the
+    nanoseconds are rounded to microseconds as as_tuple() does, through a
+    float. Returns (times, valid) as dutc_times() does; valid is also false
+    where the blob holds no number.
+    """
+    hexlify = binascii.hexlify
+    if numpy is not None:
+        times = numpy.zeros(len(blobs), dtype=numpy.int64)
+        valid = numpy.zeros(len(blobs), dtype=bool)
+        eight = numpy.array([len(blob) == 8 for blob in blobs], dtype=bool)
+        rows = numpy.flatnonzero(eight)
+        if len(rows):
+            data = numpy.frombuffer(
+                b''.join(bytes(blobs[n]) for n in rows), dtype=numpy.uint8
+            )
+            # Reversing the hex digits swaps the bytes and their nibbles
+            data = (data << numpy.uint8(4)) | (data >> numpy.uint8(4))
+            nanoseconds = data.view('<u8')
+            # Eight bytes never reach past datetime's range
+            times[rows] = _round_us(nanoseconds.astype(numpy.float64) / 1000.)
+            valid[rows] = True
+        rest = numpy.flatnonzero(~eight).tolist()
+    else:
+        times = [0] * len(blobs)
+        valid = [False] * len(blobs)
+        rest = range(len(blobs))
+
+    for n in rest:
+        try:
+            microseconds = int(hexlify(blobs[n])[::-1], 16) / 1000.
+        except (ValueError, OverflowError):
+            continue
+        time = _round_us(microseconds)
+        if time <= MAX_US:
+            times[n] = time
+            valid[n] = True
+    return times, valid
+
+
+def _round_us(microseconds):
+    # The whole part plus the fraction rounded half up, as timedelta rounds
+    # a float number of microseconds
+    if numpy is not None and isinstance(microseconds, numpy.ndarray):
+        whole = numpy.floor(microseconds)
+        return whole.astype(numpy.int64) \
+            + numpy.floor(microseconds - whole + 0.5).astype(numpy.int64)
+    whole = math.floor(microseconds)
+    return int(whole) + int(math.floor(microseconds - whole + 0.5))
+
+
+def _fill(column, mask, rows, values, valid=None):
+    """Set column at rows to values, and mark them in mask, skipping the
+    values that are not valid."""
+    if numpy is not None:
+        rows = numpy.array(rows, dtype=numpy.intp)
+        values = numpy.asarray(values, dtype=column.dtype)
+        if valid is not None:
+            rows = rows[valid]
+            values = values[valid]
+        column[rows] = values
+        mask[rows] = True
+        return
+    for n, row in enumerate(rows):
+        if valid is None or valid[n]:
+            column[row] = values[n]
+            mask[row] = 1
+
+
+def _invalid(valid):
+    """Indexes of the items of valid that are false."""
+    if numpy is not None:
+        return numpy.flatnonzero(~valid).tolist()
+    return [n for n, ok in enumerate(valid) if not ok]
+
+
+def _array_type(*typecodes):
+    """The first of typecodes the array module has with 8-byte items."""
+    for typecode in typecodes:
+        try:
+            if array.array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            pass
+    return None
+
+# array.array typecodes of the columns when numpy is not installed
+_ARRAY_TYPES = {
+    'bool': 'B',
+    'int64': _array_type('q', 'l'),
+    'uint64': _array_type('Q', 'L'),
+}
+
+
+def _column(dtype, count):
+    """A zeroed column of count items."""
+    if numpy is not None:
+        return numpy.zeros(count, dtype=dtype)
+    typecode = _ARRAY_TYPES[dtype]
+    if typecode is None:
+        return [0] * count
+    return array.array(typecode, [0]) * count
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""Decoders of the blob values of particular codes. Which code uses which
+decoder is set in ds_store_parser.registry."""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import division
+
+import re
+import struct
+import binascii
+import collections
+import biplist
+import mac_alias
+
+try:
+    unicode
+except NameError:
+    unicode = str
+
+class StructuredValue(object):
+    """Base of the values the binary codecs return: named tuples of the
+    fields unpacked from the blob. The text the reports show is only
+    built when it is asked for, with unicode() or str().
+
+    Fields named in hex_fields hold raw bytes that are shown in hex;
+    unset positions (0xffffffff) are None. The text is the "label: value"
+    strings of labelled() joined with commas, in parentheses unless
+    parenthesized is False.
+    """
+    __slots__ = ()
+    hex_fields = ()
+    parenthesized = True
+
+    def text(self):
+        fields = self.labelled()
+        if self.parenthesized:
+            return _tuple_text(fields)
+        return ", ".join(fields)
+
+    def labelled(self):
+        """Return the fields as "label: value" strings, by default each
+        labelled with its name."""
+        return tuple(
+            name + ": " + (_hex(value) if name in self.hex_fields
+                           else _field_text(value))
+            for name, value in zip(self._fields, self)
+        )
+
+    def as_dict(self):
+        """Return the fields by name, with those in hex_fields in hex."""
+        fields = self._asdict()
+        for name in self.hex_fields:
+            fields[name] = _hex(fields[name])
+        return fields
+
+    def __unicode__(self):
+        return self.text()
+
+    if str is bytes:
+        def __str__(self):
+            return self.text().encode('utf-8')
+    else:
+        def __str__(self):
+            return self.text()
+
+
+class IlocValue(StructuredValue, collections.namedtuple(
+        'IlocValue', ('x', 'y', 'index', 'unknown'))):
+    __slots__ = ()
+    hex_fields = ('unknown',)
+    parenthesized = False
+
+    def labelled(self):
+        x, y, index, unknown = self
+        return (
+            "Location: ({0}, {1})".format(_field_text(x), _field_text(y)),
+            "Selected Index: " + _field_text(index),
+            "Unknown: " + _hex(unknown)
+        )
+
+class IcvoValue(StructuredValue, collections.namedtuple(
+        'IcvoValue', ('view_type', 'icon_size', 'grid_align', 'grid_align_to',
+                      'unknown'))):
+    __slots__ = ()
+    hex_fields = ('unknown',)
+    parenthesized = False
+
+    def labelled(self):
+        return (
+            "Type: " + _fourcc(self.view_type),
+            "IconPixelSize: " + unicode(self.icon_size),
+            "GridAlign: " + _fourcc(self.grid_align),
+            "GridAlignTo: " + _fourcc(self.grid_align_to),
+            "Unknown: " + _hex(self.unknown)
+        )
+
+class Fwi0Value(StructuredValue, collections.namedtuple(
+        'Fwi0Value', ('top', 'left', 'bottom', 'right', 'view_type',
+                      'unknown'))):
+    __slots__ = ()
+    hex_fields = ('unknown',)
+
+    def labelled(self):
+        top, left, bottom, right, view_type, unknown = self
+        return (
+            'top: ' + unicode(top),
+            'left: ' + unicode(left),
+            'bottom: ' + unicode(bottom),
+            'right: ' + unicode(right),
+            'view_type: ' + _fourcc(view_type),
+            'Unknown: ' + _hex(unknown)
+        )
+
+class DilcValue(StructuredValue, collections.namedtuple(
+        'DilcValue', ('unknown1', 'grid_quadrant', 'unknown2', 'icon_pos_x',
+                      'icon_pos_y', 'grid_icon_pos_x', 'grid_icon_pos_y',
+                      'unknown3', 'unknown4'))):
+    """grid_quadrant is the quadrant of the screen the icon is in: 1 is
+    top right, 2 bottom right, 3 bottom left and 4 top left. icon_pos_x
+    and icon_pos_y count from the left and top, or when above 0xffff, back
+    from 0xffffffff from the right and bottom."""
+    __slots__ = ()
+    hex_fields = ('unknown1', 'unknown2', 'unknown3', 'unknown4')
+
+    def labelled(self):
+        (unknown1, grid_quadrant, unknown2, icon_pos_x, icon_pos_y,
+         grid_icon_pos_x, grid_icon_pos_y, unknown3, unknown4) = self
+        if icon_pos_x > 65535:
+            h_pos = "IconPosFromRight: " + unicode(4294967295 - icon_pos_x)
+        else:
+            h_pos = "IconPosFromLeft: " + unicode(icon_pos_x)
+        if icon_pos_y > 65535:
+            v_pos = "IconPosFromBottom: " + unicode(4294967295 - icon_pos_y)
+        else:
+            v_pos = "IconPosFromTop: " + unicode(icon_pos_y)
+        return (
+            "Unk1: " + _hex(unknown1),
+            "GridQuadrant: " + unicode(grid_quadrant),
+            "Unk2: " + _hex(unknown2),
+            h_pos,
+            v_pos,
+            "GridIconPosFromLeft: " + unicode(grid_icon_pos_x),
+            "GridIconPosFromTop: " + unicode(grid_icon_pos_y),
+            "Unk3: " + _hex(unknown3),
+            "Unk4: " + _hex(unknown4)
+        )
+
+_iloc = struct.Struct(b'>III')
+_fwi0 = struct.Struct(b'>HHHH')
+_dilc = struct.Struct(b'>4sH2sIIII')
+_ushort = struct.Struct(b'>H')
+
+class IlocCodec(object):
+    @staticmethod
+    def decode(bytesData):
+        x, y, index = _iloc.unpack_from(bytesData)
+        return IlocValue(
+            _unset(x), _unset(y), _unset(index), bytes(bytesData[12:16])
+        )
+
+class IcvoCodec(object):
+    @staticmethod
+    def decode(bytesData):
+        size = bytesData[4:6]
+        if len(size) == 2:
+            icon_size = _ushort.unpack(size)[0]
+        elif size:
+            icon_size = bytearray(size)[0]
+        else:
+            raise ValueError('icvo value too short')
+        return IcvoValue(
+            bytes(bytesData[:4]),
+            icon_size,
+            bytes(bytesData[6:10]),
+            bytes(bytesData[10:14]),
+            bytes(bytesData[14:])
+        )
+
+class Fwi0Codec(object):
+    @staticmethod
+    def decode(bytesData):
+        top, left, bottom, right = _fwi0.unpack_from(bytesData)
+        return Fwi0Value(
+            top, left, bottom, right,
+            bytes(bytesData[8:12]),
+            bytes(bytesData[12:16])
+        )
+
+class DilcCodec(object):
+    @staticmethod
+    def decode(bytesData):
+        fields = _dilc.unpack_from(bytesData)
+        return DilcValue(
+            *(fields + (bytes(bytesData[24:28]), bytes(bytesData[28:32])))
+        )
+
+def _unset(value):
+    if value == 4294967295:
+        return None
+    return value
+
+if str is bytes:
+    # Joins with unicode text as ASCII by itself
+    _hex = binascii.hexlify
+else:
+    def _hex(data):
+        return binascii.hexlify(data).decode('ascii')
+
+def _fourcc(data):
+    return data.decode('latin_1')
+
+def _field_text(value):
+    if value is None:
+        return "Null"
+    if isinstance(value, bytes):
+        return _fourcc(value)
+    return unicode(value)
+
+# Text that reprs as itself and that the quote stripping leaves alone
+_plain = re.compile("[^ -&(-\\[\\]-~]|\\(u").search
+
+def _tuple_text(fields):
+    # The repr of a tuple of the fields, stripped of its quotes, as the
+    # reports have always shown these values
+    text = ", ".join(fields)
+    if _plain(text) is None:
+        return "(" + text + ")"
+    return unicode(str(fields)).replace("', u'",", ").replace("'","").replace("(u","(")
+
+class PlistCodec(object):
+    @staticmethod
+    def decode(bytes):
+        return biplist.readPlistFromString(bytes)
+
+    @staticmethod
+    def freeze(value):
+        return freeze(value)
+
+class BookmarkCodec(object):
+    @staticmethod
+    def decode(bytes):
+        return mac_alias.Bookmark.from_bytes(bytes)
+
+    @staticmethod
+    def freeze(value):
+        return FrozenBookmark(value)
+
+def freeze(value):
+    """Return a read-only view of a decoded value. Dicts, lists and tuples
+    are wrapped rather than copied, so their items are listed, and their
+    repr shows them, in the same order as the value's; strings, numbers
+    and dates are returned as they are."""
+    if isinstance(value, dict):
+        return FrozenDict(value)
+    if isinstance(value, (list, tuple)) and not hasattr(value, '_fields'):
+        return FrozenList(value)
+    return value
+
+class FrozenDict(collections.Mapping):
+    """A read-only view of a dict; see freeze()."""
+    __slots__ = ('_value',)
+
+    def __init__(self, value):
+        self._value = value
+
+    def __getitem__(self, key):
+        return freeze(self._value[key])
+
+    def __iter__(self):
+        return iter(self._value)
+
+    def __len__(self):
+        return len(self._value)
+
+    def __contains__(self, key):
+        return key in self._value
+
+    def __eq__(self, other):
+        if isinstance(other, FrozenDict):
+            other = other._value
+        return self._value == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self._value)
+
+    __str__ = __repr__
+
+class FrozenList(collections.Sequence):
+    """A read-only view of a list or tuple; see freeze()."""
+    __slots__ = ('_value',)
+
+    def __init__(self, value):
+        self._value = value
+
+    def __getitem__(self, index):
+        return freeze(self._value[index])
+
+    def __iter__(self):
+        for item in self._value:
+            yield freeze(item)
+
+    def __len__(self):
+        return len(self._value)
+
+    def __eq__(self, other):
+        if isinstance(other, FrozenList):
+            other = other._value
+        return self._value == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self._value)
+
+    __str__ = __repr__
+
+class FrozenBookmark(mac_alias.Bookmark):
+    """A read-only view of a mac_alias.Bookmark; see freeze()."""
+    def __init__(self, bookmark):
+        object.__setattr__(self, 'tocs', freeze(bookmark.tocs))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("decoded values are read-only")
+
+    def __delattr__(self, name):
+        raise AttributeError("decoded values are read-only")
+
+    def __setitem__(self, key, value):
+        raise TypeError("decoded values are read-only")
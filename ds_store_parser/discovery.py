@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import fnmatch
+
+try:
+    from os import scandir
+    _entry_stat = lambda entry: entry.stat()
+except ImportError:
+    try:
+        from scandir import scandir
+        # The backport's stat_result cannot be pickled for worker
+        # processes, so take the stat from os instead.
+        _entry_stat = lambda entry: os.stat(entry.path)
+    except ImportError:
+        scandir = None
+
+
+class Discovery(object):
+    """Find candidate .DS_Store files below a source directory.
+
+    Iterating yields (path, stat_result) tuples in the same top-down order
+    as os.walk. The stat result is taken once, before the file is read, so
+    callers do not need to stat the file again.
+
+    Files reachable through more than one path (hard links, bind mounts)
+    are only yielded the first time they are seen, keyed on
+    (st_dev, st_ino). Directories are tracked the same way so a bind mount
+    is not walked twice.
+
+    Exclude patterns containing a path separator are matched against the
+    full path of a directory or file, all others against its name alone;
+    a matching directory is not descended into.
+    """
+    def __init__(self, source, pattern=u'*.DS_Store*', excludes=None):
+        self.source = source
+        self._match = _compile(pattern)
+        self._excludes = []
+        for exclude in excludes or []:
+            exclude = exclude.rstrip(u'/\\') or exclude
+            full_path = os.sep in exclude or u'/' in exclude
+            self._excludes.append((full_path, _compile(exclude)))
+
+    def __iter__(self):
+        if scandir is None:
+            return self._walk()
+        return self._scan()
+
+    def _excluded(self, name, path):
+        for full_path, match in self._excludes:
+            if match(os.path.normcase(path if full_path else name)):
+                return True
+        return False
+
+    def _scan(self):
+        seen_files = set()
+        seen_dirs = set()
+        stack = [self.source]
+
+        while stack:
+            directory = stack.pop()
+            try:
+                entries = list(scandir(directory))
+            except OSError:
+                continue
+
+            subdirs = []
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                    if is_dir and entry.is_symlink():
+                        # Like os.walk, do not follow directory links
+                        continue
+                except OSError:
+                    is_dir = False
+
+                if self._excluded(entry.name, entry.path):
+                    continue
+
+                if is_dir:
+                    try:
+                        dir_stat = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    key = (dir_stat.st_dev, dir_stat.st_ino)
+                    if dir_stat.st_ino:
+                        if key in seen_dirs:
+                            continue
+                        seen_dirs.add(key)
+                    subdirs.append(entry.path)
+                elif self._match(os.path.normcase(entry.name)):
+                    try:
+                        stat_result = _entry_stat(entry)
+                    except OSError:
+                        continue
+                    key = (stat_result.st_dev, stat_result.st_ino)
+                    if stat_result.st_ino:
+                        if key in seen_files:
+                            continue
+                        seen_files.add(key)
+                    yield entry.path, stat_result
+
+            stack.extend(reversed(subdirs))
+
+    def _walk(self):
+        # Fallback when no scandir implementation is available
+        seen_files = set()
+        for root, dirnames, filenames in os.walk(self.source):
+            dirnames[:] = [
+                d for d in dirnames
+                if not self._excluded(d, os.path.join(root, d))
+            ]
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                if not self._match(os.path.normcase(filename)):
+                    continue
+                if self._excluded(filename, path):
+                    continue
+                try:
+                    stat_result = os.stat(path)
+                except OSError:
+                    continue
+                key = (stat_result.st_dev, stat_result.st_ino)
+                if stat_result.st_ino:
+                    if key in seen_files:
+                        continue
+                    seen_files.add(key)
+                yield path, stat_result
+
+
+def _compile(pattern):
+    return re.compile(fnmatch.translate(os.path.normcase(pattern))).match
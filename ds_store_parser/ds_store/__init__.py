@@ -1,3 +1,4 @@
-from .store import DSStore, DSStoreEntry
+from .store import DSStore, DSStoreEntry, EntryFilter, DSStoreError, CycleError
 
-__all__ = ['DSStore', 'DSStoreEntry']
+__all__ = ['DSStore', 'DSStoreEntry', 'EntryFilter', 'DSStoreError',
+           'CycleError']
@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 import os
+import mmap
 import bisect
 import struct
 import binascii
+import collections
 
 try:
     {}.iterkeys
@@ -13,16 +15,46 @@ try:
     unicode
 except NameError:
     unicode = str
+try:
+    _window = buffer
+except NameError:
+    def _window(data, offset, size):
+        return memoryview(data)[offset:offset + size]
+
+# Default size limit of an Allocator's BlockCache
+DEFAULT_CACHE_BYTES = 4 * 1024 * 1024
 
 class BuddyError(Exception):
     pass
 
+def _tocname(name):
+    if not isinstance(name, bytes):
+        name = name.encode('latin_1')
+    return name
+
+def _allocate(free, size):
+    """Take a block of at least `size' bytes from the free lists, splitting
+       larger blocks as needed, and return its address (offset | log2 of
+       the block size)."""
+    width = max(5, (size - 1).bit_length())
+    level = width
+    while not free[level]:
+        level += 1
+        if level > 31:
+            raise BuddyError('Unable to allocate %lu bytes' % size)
+    offset = min(free[level])
+    free[level].remove(offset)
+    while level > width:
+        level -= 1
+        free[level].append(offset + (1 << level))
+    return offset | width
+
 class Block(object):
     def __init__(self, allocator, offset, size):
         self._allocator = allocator
         self._offset = offset
         self._size = size
-        self._value = bytearray(allocator.read(offset, size))
+        self._value = allocator.view(offset, size)
         self._pos = 0
         self._dirty = False
         
@@ -50,6 +82,12 @@ class Block(object):
     def tell(self):
         return self._pos
 
+    def buffer(self):
+        """Return the block's underlying data and the current position, for
+           decoders that parse several fields in place.  Use `seek' to move
+           past whatever they consume."""
+        return self._value, self._pos
+
     def seek(self, pos, whence=os.SEEK_SET):
         if whence == os.SEEK_CUR:
             pos += self._pos
@@ -72,24 +110,77 @@ class Block(object):
         if self._size - self._pos < size:
             raise BuddyError('Unable to read %lu bytes in block' % size)
 
+        if fmt is not None:
+            ret = struct.unpack_from(fmt, self._value, self._pos)
+            self._pos += size
+            return ret
+
         data = self._value[self._pos:self._pos + size]
         self._pos += size
-        
-        if fmt is not None:
-            if isinstance(data, bytearray):
-                return struct.unpack_from(fmt, bytes(data))
-            else:
-                return struct.unpack(fmt, data)
-        else:
-            return data
+
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return data
         
     def __str__(self):
         return binascii.b2a_hex(self._value)
         
+class BlockCache(object):
+    """The data of the blocks an Allocator read most recently, up to
+       `max_bytes' bytes; the block used longest ago is evicted first.
+       Blocks never change their data, so every Block made from a cached
+       block shares it.  Counts its hits, misses and evictions."""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._blocks = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def get(self, key):
+        data = self._blocks.pop(key, None)
+        if data is None:
+            self.misses += 1
+            return None
+        self._blocks[key] = data
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        self._blocks[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            old_data = self._blocks.popitem(last=False)[1]
+            self.size -= len(old_data)
+            self.evictions += 1
+
+    def clear(self):
+        self._blocks.clear()
+        self.size = 0
+
 class Allocator(object):
-    def __init__(self, the_file):
+    """The buddy allocator of a ``.DS_Store`` file, handing out its blocks.
+
+       Unless the file is mapped, the data of the blocks read is kept in a
+       BlockCache of up to `cache_bytes' bytes (see `cache'), so blocks
+       read again, by repeated traversals or lookups, are not read from
+       the file again; pass cache_bytes=0 to turn it off.  Mapped blocks
+       are windows onto the mapping and need no cache."""
+    def __init__(self, the_file, mapped=False, cache_bytes=DEFAULT_CACHE_BYTES):
         self._file = the_file
         self._dirty = False
+        self._map = None
+        self._data = None
+        self.cache = BlockCache(cache_bytes) if cache_bytes > 0 else None
+
+        if mapped:
+            self._map_file()
 
         self._file.seek(0)
         
@@ -130,7 +221,8 @@ class Allocator(object):
             self._free.append(list(self._root.read('>%uI' % count)))
         
     @classmethod
-    def open(cls, file_or_name, mode='r+'):
+    def open(cls, file_or_name, mode='r+', mapped=False,
+             cache_bytes=DEFAULT_CACHE_BYTES):
         if isinstance(file_or_name, (str, unicode)):
             if not 'b' in mode:
                 mode = mode[:1] + 'b' + mode[1:]
@@ -138,7 +230,77 @@ class Allocator(object):
         else:
             f = file_or_name
 
-        return Allocator(f)
+        return Allocator(f, mapped=mapped, cache_bytes=cache_bytes)
+
+    @classmethod
+    def create(cls, file_or_name, blocks, toc, mapped=False,
+               cache_bytes=DEFAULT_CACHE_BYTES):
+        """Write a new buddy file holding `blocks' and return it opened.
+           `blocks' is a list of the data of blocks 1 onwards (block 0 is
+           the allocator's own) and `toc' maps names to block numbers.
+           Blocks are allocated in order, the way a fresh file fills up,
+           and whatever is left over is recorded in the free lists.  A
+           file object must be open for reading and writing."""
+        if isinstance(file_or_name, (str, unicode)):
+            f = open(file_or_name, 'w+b')
+        else:
+            f = file_or_name
+
+        count = len(blocks) + 1
+        slots = (count + 255) & ~255
+        toc = sorted((_tocname(name), number) for name, number in toc.items())
+        # The allocator's block holds the offsets, the TOC and the free
+        # lists; a run of allocations leaves at most one free block of
+        # each size, plus the header's buddy.
+        info_size = (8 + 4 * slots + 4
+                     + sum(5 + len(name) for name, number in toc)
+                     + 32 * 4 + 4 * 33)
+
+        free = [[] for n in range(32)]
+        free[31].append(0)
+        _allocate(free, 32)         # the file header
+        addresses = [_allocate(free, info_size)]
+        for data in blocks:
+            addresses.append(_allocate(free, len(data)))
+
+        info = [struct.pack(b'>II', count, 0),
+                struct.pack(b'>%uI' % slots,
+                            *(addresses + [0] * (slots - count))),
+                struct.pack(b'>I', len(toc))]
+        for name, number in toc:
+            info.append(struct.pack(b'>B', len(name)) + name
+                        + struct.pack(b'>I', number))
+        for offsets in free:
+            info.append(struct.pack(b'>I%uI' % len(offsets), len(offsets),
+                                    *sorted(offsets)))
+
+        size = max((addr & ~0x1f) + (1 << (addr & 0x1f)) for addr in addresses)
+        data = bytearray(4 + size)
+        info_offset = addresses[0] & ~0x1f
+        struct.pack_into(b'>I4sIII', data, 0, 1, b'Bud1', info_offset,
+                         1 << (addresses[0] & 0x1f), info_offset)
+        for addr, block in zip(addresses, [b''.join(info)] + list(blocks)):
+            start = 4 + (addr & ~0x1f)
+            data[start:start + len(block)] = block
+
+        f.seek(0)
+        f.write(bytes(data))
+        f.truncate()
+        f.flush()
+        return Allocator(f, mapped=mapped, cache_bytes=cache_bytes)
+
+    def _map_file(self):
+        """Map the whole file read-only so that blocks can be handed out as
+           zero-copy windows.  File objects without a usable descriptor
+           (e.g. in-memory streams) and empty files are read into memory
+           once instead."""
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+            self._data = self._map
+        except (AttributeError, IOError, OSError, ValueError):
+            self._file.seek(0)
+            self._data = self._file.read()
 
     def __enter__(self):
         return self
@@ -148,6 +310,17 @@ class Allocator(object):
     
     def close(self):
         self.flush()
+        self._data = None
+        if self.cache is not None:
+            self.cache.clear()
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # Blocks still hold windows onto the mapping; it will be
+                # released when they go away.
+                pass
+            self._map = None
         self._file.close()
             
     def read(self, offset, size_or_format):
@@ -155,17 +328,24 @@ class Allocator(object):
            may either be a byte count, in which case we return raw data,
            or a format string for `struct.unpack', in which case we
            work out the size and unpack the data before returning it."""
-        # N.B. There is a fixed offset of four bytes(!)
-        self._file.seek(offset + 4, os.SEEK_SET)
-
         if isinstance(size_or_format, (str, unicode)):
             size = struct.calcsize(size_or_format)
             fmt = size_or_format
         else:
             size = size_or_format
             fmt = None
-        
-        ret = self._file.read(size)
+
+        # N.B. There is a fixed offset of four bytes(!)
+        start = offset + 4
+
+        if self._data is not None:
+            if fmt is not None and start + size <= len(self._data):
+                return struct.unpack_from(fmt, self._data, start)
+            ret = self._data[start:start + size]
+        else:
+            self._file.seek(start, os.SEEK_SET)
+            ret = self._file.read(size)
+
         if len(ret) < size:
             ret += b'\0' * (size - len(ret))
 
@@ -177,6 +357,23 @@ class Allocator(object):
             
         return ret
 
+    def view(self, offset, size):
+        """Return `size' bytes at `offset' for use as a block's backing
+           store.  In mapped mode this is a window onto the mapping rather
+           than a copy, unless the range runs past the end of the file.
+           Otherwise it comes from the block cache when it holds it."""
+        start = offset + 4
+        if self._data is not None and start + size <= len(self._data):
+            return _window(self._data, start, size)
+        if self.cache is None:
+            return bytearray(self.read(offset, size))
+        key = (offset, size)
+        data = self.cache.get(key)
+        if data is None:
+            data = bytearray(self.read(offset, size))
+            self.cache.put(key, data)
+        return data
+
     def get_block(self, block):
         try:
             addr = self._offsets[block]
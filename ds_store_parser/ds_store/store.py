@@ -3,10 +3,10 @@ from __future__ import unicode_literals
 from __future__ import print_function
 from __future__ import division
 
+import re
+import fnmatch
 import binascii
 import struct
-import biplist
-import mac_alias
 
 try:
     next
@@ -19,137 +19,150 @@ except NameError:
 
 from . import buddy
 
-class IlocCodec(object):
-    @staticmethod
-    def decode(bytesData):
-        if isinstance(bytesData, bytearray):
-            x, y, z = struct.unpack_from(b'>III', bytes(bytesData[:16]))
-        else:
-            x, y, z = struct.unpack(b'>III', bytesData[:16])
-            
-        h_str = str(bytesData).encode('hex')
-        
-        r_value_hor = x
-        r_value_ver = y
-        r_value_idx = z
-        if r_value_hor == 4294967295L:
-            r_value_hor = u"Null"
-        if r_value_ver == 4294967295L:
-            r_value_ver = u"Null"
-        if r_value_idx == 4294967295L:
-            r_value_idx = u"Null"
-
-        val = "Location: ({0}, {1}), Selected Index: {2}, Unknown: {3}".format(
-            unicode(r_value_hor), 
-            unicode(r_value_ver), 
-            unicode(r_value_idx),
-            h_str[24:32]
-        )
-
-        return val
-
-class IcvoCodec(object):
-    @staticmethod
-    def decode(bytesData):
-        h_str = str(bytesData).encode('hex')
-        i_type = h_str[:8].decode('hex')
-        p_size = str(int(h_str[8:12], 16))
-        g_align = h_str[12:20].decode('hex')
-        g_align_loc = h_str[20:28].decode('hex')
-        unknown = str(h_str[28:])
-        
-        val = "Type: {0}, IconPixelSize: {1}, GridAlign: {2}, GridAlignTo: {3}, Unknown: {4}".format(
-            i_type,
-            p_size,
-            g_align,
-            g_align_loc,
-            unknown
-        )
-        
-        return val
-        
-class Fwi0Codec(object):
-    @staticmethod
-    def decode(bytesData):
-        if isinstance(bytesData, bytearray):
-            w, x, y, z = struct.unpack_from(b'>HHHH', bytes(bytesData[:16]))
-        else:
-            w, x, y, z = struct.unpack(b'>HHHH', bytesData[:16])
-            
-        h_str = str(bytesData).encode('hex')
-        
-        h_array = (
-            'top: ' + str(w),
-            'left: ' + str(x),
-            'bottom: ' + str(y),
-            'right: ' + str(z),
-            'view_type: ' + h_str[16:24].decode('hex'),
-            'Unknown: ' + h_str[24:32]
-        )
-        
-        val = str(h_array).replace("', u'",", ").replace("'","").replace("(u","(")
-        
-        return val
-        
-class DilcCodec(object):
-    @staticmethod
-    def decode(bytesData):
-        if isinstance(bytesData, bytearray):
-            u, v, w, x, y, z = struct.unpack_from(b'>IIIIII', bytes(bytesData[:32]))
-        else:
-            u, v, w, x, y, z = struct.unpack(b'>IIIIII', bytesData[:32])
-        h_str = str(bytesData).encode('hex')
-        if int(h_str[16:24], 16) > 65535:
-            h_pos = "IconPosFromRight: " + str(4294967295 - int(h_str[16:24], 16))
+# The codecs blobs are decoded with, by code, when none are passed. A
+# codec is an object whose decode(bytes) method returns the blob's value;
+# callers with codecs of their own (ds_store_parser passes
+# registry.CODECS) hand their table to DSStore.open instead.
+DEFAULT_CODECS = {}
+
+# Sizes of the fixed-length value types, used to skip values unread
+value_sizes = {
+    b'bool': 1,
+    b'long': 4,
+    b'shor': 4,
+    b'type': 4,
+    b'comp': 8,
+    b'dutc': 8
+    }
+
+_uint32 = struct.Struct(b'>I')
+_uint64 = struct.Struct(b'>Q')
+_bool = struct.Struct(b'>?')
+_fourcc_struct = struct.Struct(b'>4s')
+_code_type = struct.Struct(b'>4s4s')
+
+def _bytes_at(data, start, end):
+    """Return data[start:end] as bytes; data may be a memoryview."""
+    chunk = data[start:end]
+    if isinstance(chunk, memoryview):
+        chunk = chunk.tobytes()
+    return chunk
+
+def _skip_value(block, typecode):
+    size = value_sizes.get(typecode, None)
+    if size is None:
+        if typecode == b'blob':
+            size = block.read(b'>I')[0]
+        elif typecode == b'ustr':
+            size = 2 * block.read(b'>I')[0]
         else:
-            h_pos = "IconPosFromLeft: " + str(int(h_str[16:24], 16))
-            
-        if int(h_str[24:32], 16) > 65535:
-            v_pos = "IconPosFromBottom: " + str(4294967295 - int(h_str[24:32], 16))
+            raise ValueError('Unknown type code "%s"' % typecode)
+    block.seek(block.tell() + size)
+
+def _skip_entry(block):
+    nlen = block.read(b'>I')[0]
+    block.seek(block.tell() + 2 * nlen)
+    typecode = block.read(b'>4s4s')[1]
+    _skip_value(block, typecode)
+
+def _read_key(block):
+    """Return the sort key of the entry at the current position of `block'
+    without moving past it."""
+    pos = block.tell()
+    nlen = block.read(b'>I')[0]
+    filename = block.read(2 * nlen).decode('utf-16be')
+    code = block.read(b'>4s')[0]
+    block.seek(pos)
+    return (filename.lower(), code)
+
+def _fourcc(code):
+    if isinstance(code, bytes):
+        return code
+    return code.encode('latin_1')
+
+def _fourccs(codes):
+    if codes is None:
+        return None
+    return frozenset(_fourcc(c) for c in codes)
+
+def _pack_level(encoded, children, page_size):
+    """Pack one level of a B-tree, given its entries in order, into nodes
+    of about ``page_size`` bytes.  ``children`` is ``None`` for the leaves;
+    otherwise it holds the node to the left of each entry, then the
+    rightmost node.  Returns the nodes, as (entries, children) pairs, and
+    the entries taken out to separate them, which form the level above.
+
+    A node always gets at least one entry, so entries larger than a page
+    make a larger node; so does a last entry that would be left over."""
+    nodes = []
+    promoted = []
+    child_size = 0 if children is None else 4
+    count = len(encoded)
+    start = 0
+    while True:
+        size = 8
+        end = start
+        while end < count:
+            size += child_size + len(encoded[end])
+            if size > page_size and end > start:
+                break
+            end += 1
+        if end >= count - 1:
+            end = count
+        node_children = None
+        if children is not None:
+            node_children = children[start:end + 1]
+        nodes.append((encoded[start:end], node_children))
+        if end == count:
+            return nodes, promoted
+        promoted.append(encoded[end])
+        start = end + 1
+
+class DSStoreError(buddy.BuddyError):
+    """The B-tree in a ``.DS_Store`` file is malformed."""
+    pass
+
+class CycleError(DSStoreError):
+    """A B-tree node is reachable more than once, e.g. through a pointer
+    loop in a damaged or crafted file.  ``node`` is the block number that
+    was revisited and ``parent`` the node that pointed to it."""
+    def __init__(self, node, parent):
+        super(CycleError, self).__init__(
+            'B-tree node %d referenced again from node %s' % (node, parent))
+        self.node = node
+        self.parent = parent
+
+class EntryFilter(object):
+    """Selects entries while the tree is being read, so that entries that
+    do not match are skipped by length without decoding their value or
+    creating a :class:`DSStoreEntry`.
+
+    ``codes`` and ``types`` are collections of four-character codes, e.g.
+    ``['ptbL', 'ptbN']`` or ``['dutc']`` (types are the on-disk type codes,
+    so a plist blob has type ``blob``).  ``prefix`` restricts the filename
+    to those starting with the given string and ``pattern`` to those
+    matching an :mod:`fnmatch` style glob.  All comparisons are
+    case-sensitive; criteria left as ``None`` match everything."""
+    def __init__(self, codes=None, types=None, prefix=None, pattern=None):
+        self.codes = _fourccs(codes)
+        self.types = _fourccs(types)
+        self.prefix = prefix
+        self.pattern = pattern
+        if pattern is not None:
+            self._regex = re.compile(fnmatch.translate(pattern))
         else:
-            v_pos = "IconPosFromTop: " + str(int(h_str[24:32], 16))
-        h_array = (
-            "Unk1: "+h_str[:8],
-            "GridQuadrant: "+str(int(h_str[8:12],16)),        # short?: Indicates the quadrant on the screen the icon is located. 1=top right, 2=bottom right, 3=bottom left, 4=top left
-            "Unk2: "+h_str[12:16],       # short?: Unknown. Values other than 0 have been observed
-            h_pos,       # position from right/left of screen. 0xFF indicates right position
-            v_pos,       # position from top/bottom of screen. 0xFF indicates bottom position
-            "GridIconPosFromLeft: "+str(int(h_str[32:40], 16)),       # position from left
-            "GridIconPosFromTop: "+str(int(h_str[40:48], 16)),       # position from top
-            "Unk3: "+h_str[48:56],
-            "Unk4: "+h_str[56:64]
-        )
-        
-        val = str(h_array).replace("', u'",", ").replace("'","").replace("(u","(")
-        
-        return val
-
-class PlistCodec(object):
-    @staticmethod
-    def decode(bytes):
-        return biplist.readPlistFromString(bytes)
-
-class BookmarkCodec(object):
-    @staticmethod
-    def decode(bytes):
-        return mac_alias.Bookmark.from_bytes(bytes)
-
-# This list tells the code how to decode particular kinds of entry in the
-# .DS_Store file.  This is really a convenience, and we currently only
-# support a tiny subset of the possible entry types.
-codecs = {
-    b'Iloc': IlocCodec,
-    b'icvo': IcvoCodec,
-    b'fwi0': Fwi0Codec,
-    b'dilc': DilcCodec,
-    b'bwsp': PlistCodec,
-    b'lsvp': PlistCodec,
-    b'glvp': PlistCodec,
-    b'lsvP': PlistCodec,
-    b'icvp': PlistCodec,
-    b'lsvC': PlistCodec,
-    b'pBBk': BookmarkCodec
-    }
+            self._regex = None
+
+    def match_code(self, code, typecode):
+        return ((self.codes is None or code in self.codes)
+                and (self.types is None or typecode in self.types))
+
+    def match_filename(self, filename):
+        if self.prefix is not None and not filename.startswith(self.prefix):
+            return False
+        if self._regex is not None and not self._regex.match(filename):
+            return False
+        return True
 
 class DSStoreEntry(object):
     """Holds the data from an entry in a ``.DS_Store`` file.  Note that this is
@@ -160,8 +173,14 @@ class DSStoreEntry(object):
     object's :meth:`DSStore.insert` method (which will replace a key if it
     already exists), or the mapping access mode for :class:`DSStore` (often
     simpler anyway).
+
+    Blobs that have a codec are held undecoded (pass them as ``raw``, with
+    the codec as ``typecode``) and only decoded the first time ``value`` is
+    read; the decoded value is then kept on the entry.
     """
-    def __init__(self, filename, code, typecode, value=None):
+    __slots__ = ('filename', 'code', 'type', '_value', '_raw', '_decoded')
+
+    def __init__(self, filename, code, typecode, value=None, raw=None):
         if str != bytes and type(filename) == bytes:
             filename = filename.decode('utf-8')
 
@@ -171,19 +190,58 @@ class DSStoreEntry(object):
         self.filename = filename
         self.code = code
         self.type = typecode
-        self.value = value
+        self._value = value
+        self._raw = raw
+        self._decoded = raw is None
+
+    @property
+    def value(self):
+        if not self._decoded:
+            self._value = self.type.decode(self._raw)
+            self._decoded = True
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._value = value
+        self._raw = None
+        self._decoded = True
         
     @classmethod
-    def read(cls, block):
-        """Read a ``.DS_Store`` entry from the containing Block"""
+    def read(cls, block, decode=True, entry_filter=None, codecs=None):
+        """Read a ``.DS_Store`` entry from the containing Block.  Blobs with
+        a codec in ``codecs`` (by default :data:`DEFAULT_CODECS`) are
+        decoded lazily; pass ``decode=False`` to leave every blob as raw
+        bytes with type ``blob``.
+
+        If ``entry_filter`` (an :class:`EntryFilter`) rejects the entry, the
+        block is moved past it and ``None`` is returned."""
         # First read the filename
         nlen = block.read(b'>I')[0]
-        filename = block.read(2 * nlen).decode('utf-16be')
+        if entry_filter is None:
+            filename = block.read(2 * nlen).decode('utf-16be')
 
-        # Next, read the code and type
-        code, typecode = block.read(b'>4s4s')
+            # Next, read the code and type
+            code, typecode = block.read(b'>4s4s')
+        else:
+            # Check the code and type before decoding the filename
+            name_pos = block.tell()
+            block.seek(name_pos + 2 * nlen)
+            code, typecode = block.read(b'>4s4s')
+            if not entry_filter.match_code(code, typecode):
+                _skip_value(block, typecode)
+                return None
+
+            value_pos = block.tell()
+            block.seek(name_pos)
+            filename = block.read(2 * nlen).decode('utf-16be')
+            block.seek(value_pos)
+            if not entry_filter.match_filename(filename):
+                _skip_value(block, typecode)
+                return None
 
         # Finally, read the data
+        raw = None
         if typecode == b'bool':
             value = block.read(b'>?')[0]
         elif typecode == b'long' or typecode == b'shor':
@@ -192,9 +250,13 @@ class DSStoreEntry(object):
             vlen = block.read(b'>I')[0]
             value = block.read(vlen)
 
-            codec = codecs.get(code, None)
+            codec = None
+            if decode:
+                if codecs is None:
+                    codecs = DEFAULT_CODECS
+                codec = codecs.get(code, None)
             if codec:
-                value = codec.decode(value)
+                raw, value = value, None
                 typecode = codec
         elif typecode == b'ustr':
             vlen = block.read(b'>I')[0]
@@ -206,7 +268,132 @@ class DSStoreEntry(object):
         else:
             raise ValueError('Unknown type code "%s"' % typecode)
 
-        return DSStoreEntry(filename, code, typecode, value)
+        return DSStoreEntry(filename, code, typecode, value, raw)
+
+    @classmethod
+    def read_records(cls, block, count, decode=True, entry_filter=None,
+                     codecs=None):
+        """Read ``count`` consecutive entries from the containing Block in
+        a single pass, returning them as a list.  This gives the same
+        entries as calling :meth:`read` ``count`` times, but unpacks the
+        fields with precompiled structs straight from the block's buffer,
+        and reuses the decoded filename when consecutive entries belong to
+        the same file.  A memoryview of the block is read in place; only
+        the names and values kept are copied out of it."""
+        data, pos = block.buffer()
+        size = len(data)
+        if codecs is None:
+            codecs = DEFAULT_CODECS
+        get_codec = codecs.get
+        entries = []
+        last_name = last_filename = None
+
+        for n in range(count):
+            if pos + 4 > size:
+                raise buddy.BuddyError('Unable to read entry in block')
+            nlen = _uint32.unpack_from(data, pos)[0]
+            name_pos = pos + 4
+            name_end = name_pos + 2 * nlen
+            if name_end + 8 > size:
+                raise buddy.BuddyError('Unable to read entry in block')
+            code, typecode = _code_type.unpack_from(data, name_end)
+            vpos = name_end + 8
+
+            vsize = value_sizes.get(typecode, None)
+            if vsize is None:
+                if typecode == b'blob':
+                    vsize = 1
+                elif typecode == b'ustr':
+                    vsize = 2
+                else:
+                    raise ValueError('Unknown type code "%s"' % typecode)
+                if vpos + 4 > size:
+                    raise buddy.BuddyError('Unable to read entry in block')
+                vsize *= _uint32.unpack_from(data, vpos)[0]
+                vpos += 4
+            pos = vpos + vsize
+            if pos > size:
+                raise buddy.BuddyError('Unable to read %lu bytes in block'
+                                       % vsize)
+
+            if entry_filter is not None \
+               and not entry_filter.match_code(code, typecode):
+                continue
+
+            name = _bytes_at(data, name_pos, name_end)
+            if name == last_name:
+                filename = last_filename
+            else:
+                filename = name.decode('utf-16be')
+                last_name, last_filename = name, filename
+
+            if entry_filter is not None \
+               and not entry_filter.match_filename(filename):
+                continue
+
+            raw = None
+            if typecode == b'bool':
+                value = _bool.unpack_from(data, vpos)[0]
+            elif typecode == b'long' or typecode == b'shor':
+                value = _uint32.unpack_from(data, vpos)[0]
+            elif typecode == b'blob':
+                value = _bytes_at(data, vpos, pos)
+
+                codec = get_codec(code, None) if decode else None
+                if codec:
+                    raw, value = value, None
+                    typecode = codec
+            elif typecode == b'ustr':
+                value = _bytes_at(data, vpos, pos).decode('utf-16be')
+            elif typecode == b'type':
+                value = _fourcc_struct.unpack_from(data, vpos)[0]
+            else:
+                value = _uint64.unpack_from(data, vpos)[0]
+
+            entries.append(DSStoreEntry(filename, code, typecode, value, raw))
+
+        block.seek(pos)
+        return entries
+
+    def encode(self):
+        """Return the entry as it is stored in a B-tree node.  Blobs read
+        with a codec are written back from their undecoded bytes, so an
+        entry whose decoded value was replaced cannot be encoded."""
+        filename = self.filename.encode('utf-16be')
+        typecode = self.type
+        value = self._value
+        if not isinstance(typecode, (bytes, unicode)):
+            if self._raw is None:
+                raise ValueError('Cannot encode a decoded "%s" value'
+                                 % self.code.decode('latin_1'))
+            typecode, value = b'blob', self._raw
+        typecode = _fourcc(typecode)
+
+        if typecode == b'bool':
+            data = _bool.pack(value)
+        elif typecode == b'long' or typecode == b'shor':
+            data = _uint32.pack(value)
+        elif typecode == b'blob':
+            value = bytes(value)
+            data = _uint32.pack(len(value)) + value
+        elif typecode == b'ustr':
+            value = value.encode('utf-16be')
+            data = _uint32.pack(len(value) // 2) + value
+        elif typecode == b'type':
+            data = _fourcc_struct.pack(_fourcc(value))
+        elif typecode == b'comp' or typecode == b'dutc':
+            data = _uint64.pack(value)
+        else:
+            raise ValueError('Unknown type code "%s"' % typecode)
+
+        return b''.join((_uint32.pack(len(filename) // 2), filename,
+                         _code_type.pack(self.code, typecode), data))
+
+    @property
+    def key(self):
+        """The key the store is ordered by: the case-folded filename, then
+        the code."""
+        return (self.filename.lower(), self.code)
 
     def __lt__(self, other):
         if not isinstance(other, DSStoreEntry):
@@ -228,36 +415,39 @@ class DSStoreEntry(object):
 
 
 class DSStore(object):
-    """Python interface to a ``.DS_Store`` file.  Works by manipulating the file
-    on the disk---so this code will work with ``.DS_Store`` files for *very*
-    large directories.
+    """Python interface to a ``.DS_Store`` file.  Works by reading the
+    blocks it needs from the file on the disk---so this code will work
+    with ``.DS_Store`` files for *very* large directories.
 
-    A :class:`DSStore` object can be used as if it was a mapping, e.g.::
+    A :class:`DSStore` object can be used as if it was a read-only mapping,
+    e.g.::
 
       d['foobar.dat']['Iloc']
 
     will fetch the "Iloc" record for "foobar.dat", or raise :class:`KeyError` if
-    there is no such record.  If used in this manner, the :class:`DSStore` object
-    will return (type, value) tuples, unless the type is "blob" and the module
-    knows how to decode it.
-
-    Currently, we know how to decode "Iloc", "bwsp", "lsvp", "lsvP" and "icvp"
-    blobs.  "Iloc" decodes to an (x, y) tuple, while the others are all decoded
-    using ``biplist``.
-
-    Assignment also works, e.g.::
-
-      d['foobar.dat']['note'] = ('ustr', u'Hello World!')
-
-    as does deletion with ``del``::
-
-      del d['foobar.dat']['note']
-
-    This is usually going to be the most convenient interface, though
-    occasionally (for instance when creating a new ``.DS_Store`` file) you
-    may wish to drop down to using :class:`DSStoreEntry` objects directly."""
-    def __init__(self, store):
+    there is no such record.  ``'Iloc' in d['foobar.dat']`` tests for a
+    record and iterating ``d['foobar.dat']`` yields the codes it has.  If
+    used in this manner, the :class:`DSStore` object will return (type,
+    value) tuples, unless the type is "blob" and a codec in the table
+    passed to :meth:`open` knows how to decode it.
+
+    ds_store_parser passes ``registry.CODECS``, with codecs for "Iloc",
+    "icvo", "fwi0" and "dilc", which decode to named tuples such as
+    ``IlocValue``, for the plists of "bwsp", "glvp", "icvp", "lsvC", "lsvp"
+    and "lsvP", decoded using ``biplist``, and for the "pBBk" bookmark.
+    With ``decode=False`` blobs are left as bytes.
+
+    Lookups (``d[filename]``, :meth:`find`, :meth:`get` and :meth:`range`)
+    descend the B-tree and only read the nodes on the path to the keys
+    asked for.  Filenames are compared case-insensitively, as the store is
+    ordered that way.
+
+    Records cannot be changed in place; :meth:`from_entries` writes a new
+    store from a list of :class:`DSStoreEntry` objects."""
+    def __init__(self, store, decode=True, codecs=None):
         self._store = store
+        self._decode = decode
+        self._codecs = DEFAULT_CODECS if codecs is None else codecs
         self._superblk = self._store['DSDB']
         with self._get_block(self._superblk) as s:
             self._rootnode, self._levels, self._records, \
@@ -266,39 +456,257 @@ class DSStore(object):
         self._dirty = False
         
     @classmethod
-    def open(cls, file_or_name, mode='r+', initial_entries=None):
+    def open(cls, file_or_name, mode='r+', initial_entries=None, mapped=False,
+             decode=True, cache_bytes=buddy.DEFAULT_CACHE_BYTES, codecs=None):
         """Open a ``.DS_Store`` file; pass either a Python file object, or a
         filename in the ``file_or_name`` argument and a file access mode in
         the ``mode`` argument.  If you are creating a new file using the "w"
         or "w+" modes, you may also specify a list of entries with which
-        to initialise the file."""
-        store = buddy.Allocator.open(file_or_name, mode)
+        to initialise the file.
+
+        Pass ``mapped=True`` to memory-map the file (read-only) instead of
+        issuing a seek and read for every block; blocks are then zero-copy
+        views onto the mapping.
+
+        Blobs whose code has a codec in ``codecs``, a dict by code that
+        defaults to :data:`DEFAULT_CODECS`, are decoded when an entry's
+        ``value`` is first read; pass ``decode=False`` to never decode them.
+
+        Blocks that are read are cached, up to ``cache_bytes`` bytes, so
+        that traversing the store again or looking keys up does not read
+        them from the file again; the allocator's ``cache`` counts the hits
+        and misses.  Pass ``cache_bytes=0`` to turn the cache off."""
+        if 'w' in mode:
+            entries = sorted(initial_entries or [], key=lambda e: e.key)
+            return cls.from_entries(file_or_name, entries, mapped=mapped,
+                                    decode=decode, codecs=codecs)
+
+        store = buddy.Allocator.open(file_or_name, mode, mapped=mapped,
+                                     cache_bytes=cache_bytes)
                 
-        return DSStore(store)
+        return DSStore(store, decode=decode, codecs=codecs)
+
+    @classmethod
+    def from_entries(cls, file_or_name, entries, page_size=4096,
+                     mapped=False, decode=True, codecs=None):
+        """Write a new ``.DS_Store`` file holding ``entries`` and return it
+        opened.  ``entries`` is an iterable of :class:`DSStoreEntry`
+        objects, which must already be in key order (see
+        :attr:`DSStoreEntry.key`); :exc:`ValueError` is raised if they are
+        not.
+
+        The tree is built bottom up in one pass: the leaves are filled to
+        ``page_size`` bytes in order, and the entries between them become
+        the level above, until a single root node is left.  ``file_or_name``
+        is a filename or a file object open for reading and writing."""
+        encoded = []
+        last_key = None
+        for e in entries:
+            key = e.key
+            if last_key is not None and not last_key < key:
+                raise ValueError('Entries are not in order at [%s][%s]'
+                                 % (e.filename, e.code.decode('latin_1')))
+            last_key = key
+            encoded.append(e.encode())
+        records = len(encoded)
+
+        # Pack the levels leaves first; nodes are (level, index) pairs
+        # until the tree is complete and they can be numbered.
+        levels = []
+        children = None
+        while True:
+            nodes, encoded = _pack_level(encoded, children, page_size)
+            levels.append(nodes)
+            if len(nodes) == 1:
+                break
+            depth = len(levels) - 1
+            children = [(depth, n) for n in range(len(nodes))]
+
+        # Block 1 is the superblock, then the nodes from the root down
+        numbers = {}
+        for depth in range(len(levels) - 1, -1, -1):
+            for n in range(len(levels[depth])):
+                numbers[(depth, n)] = len(numbers) + 2
+
+        blocks = [struct.pack(b'>IIIII', 2, len(levels) - 1, records,
+                              len(numbers), page_size)]
+        for depth in range(len(levels) - 1, -1, -1):
+            for node_entries, node_children in levels[depth]:
+                if node_children is None:
+                    parts = [struct.pack(b'>II', 0, len(node_entries))]
+                    parts.extend(node_entries)
+                else:
+                    parts = [struct.pack(b'>II', numbers[node_children[-1]],
+                                         len(node_entries))]
+                    for child, data in zip(node_children, node_entries):
+                        parts.append(_uint32.pack(numbers[child]))
+                        parts.append(data)
+                blocks.append(b''.join(parts))
+
+        store = buddy.Allocator.create(file_or_name, blocks, {b'DSDB': 1},
+                                       mapped=mapped)
+        return DSStore(store, decode=decode, codecs=codecs)
+
+    @property
+    def cache(self):
+        """The :class:`buddy.BlockCache` of the store's blocks, or None."""
+        return self._store.cache
 
     def _get_block(self, number):
         return self._store.get_block(number)
 
-    # Iterate over the tree, starting at `node'
-    def _traverse(self, node):
+    def _open_node(self, number, parent, visited):
+        if number in visited:
+            raise CycleError(number, parent)
+        visited.add(number)
+        block = self._get_block(number)
+        if block is None:
+            raise DSStoreError('B-tree node %d referenced from node %s '
+                               'does not exist' % (number, parent))
+        next_node, count = block.read(b'>II')
+        return block, next_node, count
+
+    # Iterate over the tree, starting at `node', yielding the entries with
+    # lo <= key < hi (either bound may be None).  Subtrees that cannot hold
+    # such keys are not read.  The walk keeps its own stack of internal
+    # nodes rather than recursing, and refuses to visit a node twice.
+    def _traverse(self, node, entry_filter=None, lo=None, hi=None):
         if node is None:
             node = self._rootnode
-        with self._get_block(node) as block:
-            next_node, count = block.read(b'>II')
-            if next_node:
-                for n in range(count):
-                    ptr = block.read(b'>I')[0]
-                    for e in self._traverse(ptr):
+        decode = self._decode
+        codecs = self._codecs
+        bounded = lo is not None or hi is not None
+        visited = set()
+        # Each frame is [block, next_node, entries left, entry pending, node]
+        stack = []
+        parent = None
+
+        while True:
+            if node is not None:
+                block, next_node, count = self._open_node(node, parent,
+                                                          visited)
+                if next_node:
+                    stack.append([block, next_node, count, False, node])
+                elif not bounded:
+                    for e in DSStoreEntry.read_records(block, count, decode,
+                                                       entry_filter, codecs):
                         yield e
-                    e = DSStoreEntry.read(block)
-                    yield e
-                for e in self._traverse(next_node):
+                else:
+                    for n in range(count):
+                        key = _read_key(block)
+                        if hi is not None and key >= hi:
+                            return
+                        if lo is not None and key < lo:
+                            _skip_entry(block)
+                            continue
+                        e = DSStoreEntry.read(block, decode, entry_filter,
+                                              codecs)
+                        if e is not None:
+                            yield e
+                node = None
+
+            if not stack:
+                return
+
+            frame = stack[-1]
+            block = frame[0]
+            if frame[3]:
+                # The subtree before this entry is done; now the entry
+                frame[3] = False
+                if bounded:
+                    key = _read_key(block)
+                    if hi is not None and key >= hi:
+                        return
+                    if lo is not None and key < lo:
+                        _skip_entry(block)
+                        continue
+                e = DSStoreEntry.read(block, decode, entry_filter, codecs)
+                if e is not None:
                     yield e
+            elif frame[2]:
+                frame[2] -= 1
+                frame[3] = True
+                ptr = block.read(b'>I')[0]
+                # The subtree at `ptr' holds the keys below the next entry's
+                if lo is not None and not lo < _read_key(block):
+                    continue
+                node, parent = ptr, frame[4]
             else:
-                for n in range(count):
-                    e = DSStoreEntry.read(block)
-                    yield e
+                stack.pop()
+                node, parent = frame[1], frame[4]
 
     def __iter__(self):
         return self._traverse(self._rootnode)
+
+    def filter(self, entry_filter=None, **criteria):
+        """Iterate over the entries matching ``entry_filter``, or an
+        :class:`EntryFilter` built from the keyword arguments, e.g.::
+
+          d.filter(codes=['ptbL', 'ptbN'])
+
+        Entries that do not match are skipped before their values are
+        read.  With neither, every entry is read, as iterating does."""
+        if entry_filter is None and criteria:
+            entry_filter = EntryFilter(**criteria)
+        return self._traverse(self._rootnode, entry_filter)
+
+    def find(self, filename, code=None):
+        """Iterate over the entries for ``filename``, or only its ``code``
+        entry if one is given."""
+        filename = filename.lower()
+        if code is None:
+            lo = (filename, b'')
+            hi = (filename + '\0', b'')
+        else:
+            code = _fourcc(code)
+            lo = (filename, code)
+            hi = (filename, code + b'\0')
+        return self._traverse(self._rootnode, lo=lo, hi=hi)
+
+    def get(self, filename, code, default=None):
+        """Return the ``code`` entry for ``filename``, or ``default``."""
+        for e in self.find(filename, code):
+            return e
+        return default
+
+    def range(self, filename_lo=None, filename_hi=None):
+        """Iterate, in order, over the entries whose filename is at least
+        ``filename_lo`` and below ``filename_hi``.  Either bound may be
+        ``None`` to leave that end of the range open."""
+        lo = hi = None
+        if filename_lo is not None:
+            lo = (filename_lo.lower(), b'')
+        if filename_hi is not None:
+            hi = (filename_hi.lower(), b'')
+        return self._traverse(self._rootnode, lo=lo, hi=hi)
+
+    def __contains__(self, filename):
+        for e in self.find(filename):
+            return True
+        return False
+
+    def __getitem__(self, filename):
+        return self.Partial(self, filename)
+
+    class Partial(object):
+        """The entries for one filename, as returned by ``d[filename]``."""
+        def __init__(self, store, filename):
+            self._store = store
+            self._filename = filename
+
+        def __getitem__(self, code):
+            e = self._store.get(self._filename, code)
+            if e is None:
+                raise KeyError('no such key - [%s][%s]' % (self._filename,
+                                                           code))
+            if isinstance(e.type, bytes):
+                return (e.type, e.value)
+            return e.value
+
+        def __contains__(self, code):
+            return self._store.get(self._filename, code) is not None
+
+        def __iter__(self):
+            for e in self._store.find(self._filename):
+                yield e.code
     
@@ -1,17 +1,26 @@
 from ds_store import store as ds_store
+from ds_store_parser import registry
+from ds_store_parser.columnar import RecordBatch
 import datetime
 import binascii
+import itertools
 import collections
 import struct
 
 
 class DsStoreHandler(object):
-    """Wrapper class for handling the DS Store artifact."""
-    def __init__(self, file_io, location):
+    """Wrapper class for handling the DS Store artifact.
+
+    If entry_filter (a ds_store.EntryFilter) is given, iterating only yields
+    the matching records; the rest are skipped while the store is read.
+    """
+    def __init__(self, file_io, location, mapped=False, decode=True, entry_filter=None):
         self._file_io = file_io
         self.location = location
+        self.entry_filter = entry_filter
         self.ds_store = ds_store.DSStore.open(
-            self._file_io, "rb"
+            self._file_io, "rb", mapped=mapped, decode=decode,
+            codecs=registry.CODECS
         )
 
     def __iter__(self):
@@ -20,51 +29,65 @@ class DsStoreHandler(object):
         Yields
             <DsStoreRecord>: The ds store entry record
         """
-        for ds_store_entry in self.ds_store:
+        for ds_store_entry in self.ds_store.filter(self.entry_filter):
             yield DsStoreRecord(ds_store_entry)
 
+    def batches(self, size=65536):
+        """Iterate the entries within the store as columns.
+
+        Yields
+            <RecordBatch>: The next `size' records, or those left
+        """
+        entries = self.ds_store.filter(self.entry_filter)
+        while True:
+            batch = list(itertools.islice(entries, size))
+            if not batch:
+                return
+            yield RecordBatch.from_entries(batch)
+
 
 class DsStoreRecord(object):
     """A wrapper class for the DSStoreEntry."""
+    __slots__ = ("ds_store_entry",)
+
+    fields = ("filename", "type", "code", "value")
+
     def __init__(self, ds_store_entry):
         self.ds_store_entry = ds_store_entry
 
-    def as_dict(self):
-        """Turn the internal DSStoreEntry into a OrderedDict.
+    def as_tuple(self):
+        """Turn the internal DSStoreEntry into a tuple.
 
         Returns
-            <OrderedDict>: The ordered dictionary representing the internal DSStoreEntry.
+            <tuple>: The (filename, type, code, value) of the internal DSStoreEntry.
         """
-        record_dict = collections.OrderedDict([
-            ("filename", self.ds_store_entry.filename),
-            ("type", self.ds_store_entry.type),
-            ("code", self.ds_store_entry.code),
-            ("value", self.ds_store_entry.value),
-        ])
-
-        if hasattr(self.ds_store_entry.type, "__name__"):
-            record_dict["type"] = self.ds_store_entry.type.__name__
-        
-        
-        if record_dict["type"] == "blob" and record_dict["code"].lower() =='modd':           
-            record_dict["value"] = binascii.hexlify(
-                record_dict["value"]
-            )
+        entry_type = self.ds_store_entry.type
+        code = self.ds_store_entry.code
+        value = self.ds_store_entry.value
+
+        if hasattr(entry_type, "__name__"):
+            entry_type = entry_type.__name__
+
+        if entry_type == "blob" and code.lower() =='modd':           
+            value = binascii.hexlify(value)
             epoch_dt = datetime.datetime(1970,1,1) 
-            parsed_dt = epoch_dt + datetime.timedelta(microseconds=int(record_dict["value"][::-1],16) / 1000. )
-            record_dict["value"] = parsed_dt
+            value = epoch_dt + datetime.timedelta(microseconds=int(value[::-1],16) / 1000. )
             
-        elif record_dict["type"] == "blob":
-            record_dict["value"] = binascii.hexlify(
-                record_dict["value"]
-            )
+        elif entry_type == "blob":
+            value = binascii.hexlify(value)
             
-        elif record_dict["type"] == 'dutc':
+        elif entry_type == 'dutc':
             epoch_dt = datetime.datetime(1904, 1, 1)
-            parsed_dt = epoch_dt + datetime.timedelta(
-                seconds=int(self.ds_store_entry.value) / 65536
+            value = epoch_dt + datetime.timedelta(
+                seconds=int(value) / 65536
             )
-            record_dict["value"] = parsed_dt
 
+        return (self.ds_store_entry.filename, entry_type, code, value)
+
+    def as_dict(self):
+        """Turn the internal DSStoreEntry into a OrderedDict.
 
-        return record_dict
+        Returns
+            <OrderedDict>: The ordered dictionary representing the internal DSStoreEntry.
+        """
+        return collections.OrderedDict(zip(self.fields, self.as_tuple()))
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+import threading
+from multiprocessing.pool import ThreadPool
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+class LoadedStat(object):
+    """A file's stat_result together with its contents, read ahead of the
+    parser. Other attributes are those of the stat_result."""
+    def __init__(self, stat_result, data):
+        self.stat_result = stat_result
+        self.data = data
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name == 'stat_result':
+            raise AttributeError(name)
+        return getattr(self.stat_result, name)
+
+
+class ReadAhead(object):
+    """Read whole files ahead of the parser.
+
+    Wraps an iterable of (path, stat_result) tuples, such as a Discovery,
+    and yields them in the same order with each stat_result replaced by a
+    LoadedStat holding the file's contents. The iterable is consumed on a
+    thread of its own and up to `threads' files are read at once, so the
+    round trips of a slow or network file system overlap with parsing
+    instead of holding it up.
+
+    Reading pauses while the files read but not yet handed on add up to
+    more than max_bytes, or number more than max_files; a single file
+    larger than max_bytes is still read. Files that cannot be read are
+    passed on as they came, and the parser reports the error when it opens
+    them. Entries that already carry their data, like archive members and
+    carved stores, are passed straight through, their data counting
+    against the same limits.
+    """
+    def __init__(self, files, threads=4, max_bytes=64 * 1024 * 1024,
+                 max_files=1024):
+        self.files = files
+        self.threads = threads
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+
+    def __iter__(self):
+        pool = ThreadPool(self.threads)
+        budget = _Budget(self.max_bytes, self.max_files)
+        # The budget holds the feeder back first; the queue only has to
+        # have room for the files it lets through, an error and the end
+        pending = queue.Queue(self.max_files + 2)
+        feeder = threading.Thread(target=self._feed, args=(pool, budget, pending))
+        feeder.daemon = True
+        feeder.start()
+        try:
+            while True:
+                item = pending.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                result, size = item
+                entry = result.get()
+                budget.release(size)
+                yield entry
+        finally:
+            budget.close()
+            # Threads still reading are let finish; nothing waits on them
+            pool.close()
+
+    def _feed(self, pool, budget, pending):
+        try:
+            for path, stat_result in self.files:
+                data = getattr(stat_result, 'data', None)
+                if data is not None:
+                    size = len(data)
+                else:
+                    size = stat_result.st_size
+                if not budget.acquire(size):
+                    return
+                pending.put((pool.apply_async(_load, (path, stat_result)), size))
+        except Exception as exp:
+            pending.put(exp)
+        finally:
+            pending.put(None)
+
+
+def _load(path, stat_result):
+    if getattr(stat_result, 'data', None) is not None:
+        return path, stat_result
+    try:
+        with open(path, 'rb') as file_io:
+            data = file_io.read()
+    except (IOError, OSError):
+        return path, stat_result
+    return path, LoadedStat(stat_result, data)
+
+
+class _Budget(object):
+    """Bytes and files held by files read ahead, up to limits."""
+    def __init__(self, limit, max_files):
+        self.limit = limit
+        self.max_files = max_files
+        self.used = 0
+        self.files = 0
+        self.closed = False
+        self._condition = threading.Condition()
+
+    def acquire(self, size):
+        """Wait until one more file of `size' bytes fits; False once
+        closed."""
+        with self._condition:
+            while (self.files and not self.closed
+                   and (self.used + size > self.limit
+                        or self.files >= self.max_files)):
+                self._condition.wait()
+            self.used += size
+            self.files += 1
+            return not self.closed
+
+    def release(self, size):
+        with self._condition:
+            self.used -= size
+            self.files -= 1
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""What the parser knows about each four-character record code.
+
+Each code has a row in TABLE: its report category, the description that
+prefixes its values in the reports, the type it is stored as and, for
+blobs with a known layout, the codec that decodes them. The lookup tables
+below are built from it once, so classifying a record is a single dict
+lookup; DSStoreEntry.read decodes through CODECS and the reports classify
+and describe through CATEGORIES and DESCRIPTIONS.
+
+Site-specific codes are added, or built-in ones replaced, with register(),
+typically from a module named with DSStoreParser's --plugin option.
+"""
+import hashlib
+import collections
+import importlib
+
+from ds_store_parser.decoders import (IlocCodec, IcvoCodec, Fwi0Codec,
+                                      DilcCodec, PlistCodec, BookmarkCodec)
+
+# Report categories, each written to its own TSV report
+FOLDER_ACCESS = u"folder_access"
+OTHER_INFO = u"other_info"
+
+# Codes in the folder access category indicate the finder window changed
+# for an open folder, or the folder was opened. Those in other info do not
+# always mean that a folder was opened: some are informational and may
+# indicate the parent was opened, not the path reported.
+TABLE = (
+    # code, category, value type, codec, description
+    ("BKGD", FOLDER_ACCESS, b"blob", None, u"Finder Folder Background Picture Changed: "),
+    ("ICVO", FOLDER_ACCESS, b"bool", None, u"ICVO. Unknown. Icon View Options?: "),
+    ("Iloc", OTHER_INFO, b"blob", IlocCodec, u"Icon Location or Index Changed: "),
+    ("LSVO", FOLDER_ACCESS, b"bool", None, u"LSVO. Unknown. List View Options? Changed: "),
+    ("bwsp", FOLDER_ACCESS, b"blob", PlistCodec, u"Finder Window Work Space Changed"),
+    ("cmmt", OTHER_INFO, b"ustr", None, u"Spotlight Comments Changed: "),
+    ("dilc", OTHER_INFO, b"blob", DilcCodec, u"Desktop Icon Location Changed: "),
+    ("dscl", FOLDER_ACCESS, b"bool", None, u"Is Directory Expanded in List View: "),
+    ("fdsc", FOLDER_ACCESS, b"bool", None, u"Is Directory Expanded in Limited Finder Window: "),
+    ("extn", OTHER_INFO, b"ustr", None, u"File Extension: "),
+    ("fwi0", FOLDER_ACCESS, b"blob", Fwi0Codec, u"Finder Window Information Changed: "),
+    ("fwsw", FOLDER_ACCESS, b"long", None, u"Finder window sidebar widt changed: "),
+    ("fwvh", FOLDER_ACCESS, b"shor", None, u"Finder window sidebar height changed: "),
+    ("glvp", FOLDER_ACCESS, b"blob", PlistCodec, u"Gallery View Properties Changed: "),
+    ("GRP0", FOLDER_ACCESS, b"ustr", None, u"Group by Changed. Group Items by: "),
+    ("icgo", FOLDER_ACCESS, b"blob", None, u"icgo. Unknown. Icon View?: "),
+    ("icsp", FOLDER_ACCESS, b"blob", None, u"icsp. Unknown. Icom View?: "),
+    ("icvo", FOLDER_ACCESS, b"blob", IcvoCodec, u"Icon View Options Changed: "),
+    ("icvp", FOLDER_ACCESS, b"blob", PlistCodec, u"Icon View Properties Changed: "),
+    ("icvt", FOLDER_ACCESS, b"shor", None, u"Icon View Text Changed: "),
+    ("info", FOLDER_ACCESS, b"blob", None, u"info: Unknown. Finder Info?:"),
+    ("logS", OTHER_INFO, b"comp", None, u"Logical size gathered: "),
+    ("lg1S", OTHER_INFO, b"comp", None, u"Logical size gathered: "),
+    ("lssp", FOLDER_ACCESS, b"blob", None, u"lssp. Unknown. List view scroll position changed?: "),
+    ("lsvC", FOLDER_ACCESS, b"blob", PlistCodec, u"List View Columns Changed: "),
+    ("lsvo", FOLDER_ACCESS, b"blob", None, u"List View Options Changed: "),
+    ("lsvt", FOLDER_ACCESS, b"shor", None, u"List View Text Size Changed: "),
+    ("lsvp", FOLDER_ACCESS, b"blob", PlistCodec, u"List View Properties Changed: "),
+    ("lsvP", FOLDER_ACCESS, b"blob", PlistCodec, u"List View Properties Changed: "),
+    ("modD", OTHER_INFO, b"blob", None, u"Modified date gathered: "),
+    ("moDD", OTHER_INFO, b"dutc", None, u"Modified date gathered: "),
+    ("phyS", OTHER_INFO, b"comp", None, u"Physical size gathered: "),
+    ("ph1S", OTHER_INFO, b"comp", None, u"Physical size gathered: "),
+    ("pict", FOLDER_ACCESS, b"blob", None, u"pict. Unknown. Background image changed?: "),
+    ("vSrn", FOLDER_ACCESS, b"long", None, u"Opened Folder in new tab: "),
+    ("bRsV", FOLDER_ACCESS, b"type", None, u"Browse in Selected View: "),
+    ("pBBk", FOLDER_ACCESS, b"blob", BookmarkCodec, u"Finder Folder Background Image Bookmark Changed: "),
+    ("vstl", FOLDER_ACCESS, b"type", None, u"View Style Changed: "),
+    ("ptbL", OTHER_INFO, b"ustr", None, u"Originally sent to Trash. Trash Put Back Location: "),
+    ("ptbN", OTHER_INFO, b"ustr", None, u"Originally sent to Trash. Trash Put Back Name: "),
+)
+
+CodeInfo = collections.namedtuple('CodeInfo', (
+    'code', 'category', 'value_type', 'codec', 'description'
+))
+
+# Lookup tables, by code
+CODES = {}
+CATEGORIES = {}
+DESCRIPTIONS = {}
+CODECS = {}
+
+
+def register(code, category=None, value_type=None, codec=None, description=None):
+    """Add a code, or replace what is known about it.
+
+    category is FOLDER_ACCESS, OTHER_INFO or None for records left out of
+    the category reports. codec is an object whose decode(bytes) method
+    turns the code's blob values into something else; its __name__ is
+    reported as the record's type. Only records read after the call are
+    affected.
+    """
+    if not isinstance(code, bytes):
+        code = code.encode('latin_1')
+    CODES[code] = CodeInfo(code, category, value_type, codec, description)
+    for table, value in ((CATEGORIES, category),
+                         (DESCRIPTIONS, description),
+                         (CODECS, codec)):
+        if value is None:
+            table.pop(code, None)
+        else:
+            table[code] = value
+
+
+def fingerprint():
+    """Return a digest of what is registered, which changes whenever a code
+    is registered differently, e.g. by another set of plugins."""
+    parts = []
+    for code in sorted(CODES):
+        info = CODES[code]
+        codec = info.codec
+        if codec is not None:
+            codec = u"{0}.{1}".format(
+                getattr(codec, '__module__', u""),
+                getattr(codec, '__name__', type(codec).__name__)
+            )
+        parts.append((code, info.category, info.value_type, codec,
+                      info.description))
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+
+def load_plugins(names):
+    """Import the named modules, which register their codes on import."""
+    for name in names:
+        importlib.import_module(name)
+
+
+for _row in TABLE:
+    register(*_row)
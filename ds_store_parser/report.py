@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import collections
+from ds_store_parser import registry
+from ds_store_parser.registry import FOLDER_ACCESS, OTHER_INFO
+
+try:
+    unicode
+except NameError:
+    unicode = str
+
+# Columns of the DSStoreParser reports, in output order
+REPORT_FIELDS = (
+    u"ds_store_path_and_record_filename",
+    u"filename",
+    u"value",
+    u"type",
+    u"code",
+    u"source_size",
+    u"source_mod_time",
+    u"source_chg_time",
+    u"source_create_time",
+    u"source_acc_time",
+    u"source_file",
+)
+
+# One report row. Being a tuple it needs no per-record dict and can be
+# handed straight to a csv writer.
+ReportRow = collections.namedtuple('ReportRow', REPORT_FIELDS)
+
+VIEW_STYLES = {
+    '\x00\x00\x00\x00': u"view type null",
+    "none": u"View Type Unselected",
+    "icnv": u"icnv: Icon View",
+    "clmv": u"clmv: Column View",
+    "Nlsv": u"Nlsv: List View Applied",
+    "glyv": u"glyv: Gallery View",
+    "Flwv": u"Flwv: CoverFlow View"
+}
+
+
+def category(code):
+    """Return the report category of a code, or None if it has none."""
+    return registry.CATEGORIES.get(code)
+
+
+def describe(code):
+    """Return the description that prefixes a code's value in the reports."""
+    try:
+        return registry.DESCRIPTIONS[code]
+    except KeyError:
+        return u"Unknown Code: {0}".format(code)
+
+
+def view_style(value):
+    """Return the description of a vstl view style."""
+    try:
+        return VIEW_STYLES[value]
+    except (KeyError, TypeError):
+        return u"Unknown Code: {0}".format(value)
+
+
+class RenderedValue(unicode):
+    """A value's report text that still carries the value itself.
+
+    Worker processes render rows before they are pickled back to the
+    parent: on Python 2 the repr order of a dict is not kept when it is
+    unpickled, so rendering afterwards would not match a serial run.
+    """
+    def __new__(cls, text, value):
+        rendered = unicode.__new__(cls, text)
+        rendered.value = value
+        return rendered
+
+    def __reduce__(self):
+        # The value goes in the arguments only, not again as instance state
+        return RenderedValue, (unicode(self), self.value)
+
+
+def rendered(code, value, keep_value=True):
+    """Return value as a RenderedValue, rendering it unless it already is.
+
+    Without keep_value, the RenderedValue only carries the text.
+    """
+    if isinstance(value, RenderedValue):
+        if keep_value or value.value is None:
+            return value
+        return RenderedValue(value, None)
+    return RenderedValue(render_value(code, value), value if keep_value else None)
+
+
+def render_value(code, value):
+    """Render a row's value as the human-readable report text."""
+    if isinstance(value, RenderedValue):
+        return value
+    if code == "vstl":
+        value = view_style(value)
+    if not isinstance(value, unicode):
+        value = unicode(value)
+    return describe(code) + value
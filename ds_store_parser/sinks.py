@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+import os
+import abc
+import json
+import base64
+import sqlite3
+import datetime
+import collections
+import unicodecsv as csv
+from ds_store_parser import report
+from ds_store_parser.decoders import StructuredValue, FrozenDict, FrozenList
+
+try:
+    unicode
+except NameError:
+    unicode = str
+try:
+    long
+except NameError:
+    long = int
+
+ALL_RECORDS_TSV = u'DS_Store-All_Parsed_Report.tsv'
+FOLDER_ACCESS_TSV = u'DS_Store-Folder_Access_Report.tsv'
+OTHER_INFO_TSV = u'DS_Store-Miscellaneous_Info_Report.tsv'
+ALL_RECORDS_JSONL = u'DS_Store-All_Parsed_Report.jsonl'
+
+
+# ABCMeta as a base, which Python 2 and 3 both accept
+_Abstract = abc.ABCMeta('_Abstract', (object,), {})
+
+
+class RecordSink(_Abstract):
+    """Destination for report rows.
+
+    A sink is opened once, fed batches of ReportRow through write_rows and
+    closed at the end of the run. Subclasses must implement write_rows.
+
+    structured tells whether the sink uses the structure of row values,
+    through to_json(), rather than only their report text.
+    """
+    structured = True
+
+    @abc.abstractmethod
+    def write_rows(self, rows):
+        """Write a batch of ReportRow."""
+
+    def close(self):
+        pass
+
+
+class TsvSink(RecordSink):
+    """The tab separated reports: every row goes to the all records report
+    and, depending on its code's category, to the folder access or the
+    miscellaneous info report."""
+    structured = False
+
+    def __init__(self, outdir):
+        self._files = []
+        self.all_writer = self._open(outdir, ALL_RECORDS_TSV)
+        self.category_writers = {
+            report.FOLDER_ACCESS: self._open(outdir, FOLDER_ACCESS_TSV),
+            report.OTHER_INFO: self._open(outdir, OTHER_INFO_TSV),
+        }
+
+    def _open(self, outdir, name):
+        report_file = open(os.path.join(outdir, name), 'wb')
+        self._files.append(report_file)
+        writer = csv.writer(report_file, delimiter="\t", lineterminator="\n")
+        writer.writerow(report.REPORT_FIELDS)
+        return writer
+
+    def write_rows(self, rows):
+        all_writer = self.all_writer
+        category_writers = self.category_writers
+        render_value = report.render_value
+        for row in rows:
+            row = row._replace(value=render_value(row.code, row.value))
+            all_writer.writerow(row)
+            writer = category_writers.get(report.category(row.code))
+            if writer is not None:
+                writer.writerow(row)
+
+    def close(self):
+        for report_file in self._files:
+            report_file.close()
+
+
+class JsonLinesSink(RecordSink):
+    """All rows as JSON Lines, one object per record.
+
+    Values keep their structure: decoded plists become JSON objects and
+    arrays, dates ISO 8601 strings and binary data hex strings. The report
+    description of the code is given in its own "description" field.
+    """
+    def __init__(self, outdir):
+        self._file = open(os.path.join(outdir, ALL_RECORDS_JSONL), 'wb')
+
+    def write_rows(self, rows):
+        lines = []
+        for row in rows:
+            record = collections.OrderedDict(zip(report.REPORT_FIELDS, row))
+            record[u"value"] = to_json(row.value)
+            record[u"description"] = report.describe(row.code).rstrip(u": ")
+            lines.append(json.dumps(record, separators=(',', ':')))
+        if lines:
+            self._file.write('\n'.join(lines).encode('utf-8') + b'\n')
+
+    def close(self):
+        self._file.close()
+
+
+class SqliteSink(RecordSink):
+    """All rows in a SQLite database.
+
+    Source files and their stat details go to the source_files table and
+    records to the records table. The folder access and miscellaneous info
+    reports are the folder_access and other_info views, and all_records
+    joins both tables back into the report columns.
+
+    Rows are inserted in batches of batch_size inside one transaction and
+    the indexes are only built on close, after the load. A database that
+    exists already keeps its other tables; these tables and views, from an
+    earlier run, are dropped and made again.
+    """
+    SCHEMA = u"""
+        CREATE TABLE source_files (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL,
+            size INTEGER,
+            mod_time TEXT,
+            chg_time TEXT,
+            create_time TEXT,
+            acc_time TEXT
+        );
+        CREATE TABLE records (
+            id INTEGER PRIMARY KEY,
+            source_file_id INTEGER NOT NULL REFERENCES source_files (id),
+            path TEXT,
+            filename TEXT,
+            code TEXT,
+            type TEXT,
+            category TEXT,
+            value TEXT,
+            value_json TEXT
+        );
+        CREATE VIEW all_records AS
+            SELECT r.path AS ds_store_path_and_record_filename,
+                   r.filename AS filename,
+                   r.value AS value,
+                   r.type AS type,
+                   r.code AS code,
+                   s.size AS source_size,
+                   s.mod_time AS source_mod_time,
+                   s.chg_time AS source_chg_time,
+                   s.create_time AS source_create_time,
+                   s.acc_time AS source_acc_time,
+                   s.path AS source_file,
+                   r.category AS category
+            FROM records r JOIN source_files s ON s.id = r.source_file_id;
+        CREATE VIEW folder_access AS
+            SELECT * FROM all_records WHERE category = '{0}';
+        CREATE VIEW other_info AS
+            SELECT * FROM all_records WHERE category = '{1}';
+    """.format(report.FOLDER_ACCESS, report.OTHER_INFO)
+
+    DROP = u"""
+        DROP VIEW IF EXISTS other_info;
+        DROP VIEW IF EXISTS folder_access;
+        DROP VIEW IF EXISTS all_records;
+        DROP TABLE IF EXISTS records;
+        DROP TABLE IF EXISTS source_files;
+    """
+
+    INDEXES = u"""
+        CREATE INDEX records_code ON records (code);
+        CREATE INDEX records_filename ON records (filename);
+        CREATE INDEX records_path ON records (path);
+        CREATE INDEX records_source_file ON records (source_file_id);
+        CREATE INDEX source_files_path ON source_files (path);
+    """
+
+    def __init__(self, path, batch_size=10000):
+        new = not os.path.exists(path)
+        self.batch_size = batch_size
+        self._db = sqlite3.connect(path)
+        if new:
+            # Nothing in a new database to protect from a crash part way
+            # through the load
+            self._db.execute(u"PRAGMA journal_mode = OFF")
+            self._db.execute(u"PRAGMA synchronous = OFF")
+        self._db.executescript(self.DROP + self.SCHEMA)
+        self._source_ids = {}
+        self._sources = []
+        self._records = []
+
+    def write_rows(self, rows):
+        source_ids = self._source_ids
+        records = self._records
+        render_value = report.render_value
+        category = report.category
+        for row in rows:
+            source_id = source_ids.get(row.source_file)
+            if source_id is None:
+                source_id = source_ids[row.source_file] = len(source_ids) + 1
+                self._sources.append((
+                    source_id, row.source_file, row.source_size,
+                    row.source_mod_time, row.source_chg_time,
+                    row.source_create_time, row.source_acc_time
+                ))
+            records.append((
+                source_id,
+                row.ds_store_path_and_record_filename,
+                row.filename,
+                row.code,
+                row.type,
+                category(row.code),
+                render_value(row.code, row.value),
+                json.dumps(to_json(row.value), separators=(',', ':')),
+            ))
+        if len(records) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        if self._sources:
+            self._db.executemany(
+                u"INSERT INTO source_files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                self._sources
+            )
+            self._sources = []
+        if self._records:
+            self._db.executemany(
+                u"INSERT INTO records (source_file_id, path, filename, code,"
+                u" type, category, value, value_json)"
+                u" VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                self._records
+            )
+            self._records = []
+
+    def close(self):
+        self._flush()
+        self._db.commit()
+        self._db.executescript(self.INDEXES)
+        self._db.commit()
+        self._db.close()
+
+
+def to_json(value):
+    """Convert a decoded record value into JSON-serializable data."""
+    if isinstance(value, report.RenderedValue):
+        value = value.value
+    if value is None or isinstance(value, (bool, int, long, float, unicode)):
+        return value
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat(" ")
+    if isinstance(value, StructuredValue):
+        return collections.OrderedDict(
+            (unicode(k), to_json(v)) for k, v in value.as_dict().items()
+        )
+    if isinstance(value, (dict, FrozenDict)):
+        return collections.OrderedDict(
+            (unicode(k), to_json(v)) for k, v in sorted(value.items())
+        )
+    if isinstance(value, (list, tuple, FrozenList)):
+        return [to_json(v) for v in value]
+    if isinstance(value, bytearray):
+        return base64.b16encode(bytes(value)).lower().decode('ascii')
+    if isinstance(value, bytes):
+        try:
+            # Plain strings from plists; binary data falls through to hex
+            if type(value) is bytes:
+                return value.decode('ascii')
+        except UnicodeDecodeError:
+            pass
+        return base64.b16encode(value).lower().decode('ascii')
+    return unicode(value)
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+import time
+import collections
+from ds_store_parser import registry
+
+
+class Stats(object):
+    """Wall time and call counts per pipeline stage, plus plain counters.
+
+    Stages are timed with the timer() context manager or, for iterators,
+    timed(), which times every step of the iteration. Codec decoding is
+    timed per codec once instrument_codecs() has been called. Stats from
+    worker processes are combined with merge().
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.timers = collections.defaultdict(lambda: [0, 0.0])
+        self.counters = collections.defaultdict(int)
+        self.codes = collections.defaultdict(int)
+
+    def timer(self, name):
+        return _Timer(self, name)
+
+    def add_time(self, name, seconds, calls=1):
+        timer = self.timers[name]
+        timer[0] += calls
+        timer[1] += seconds
+
+    def timed(self, name, iterable):
+        """Iterate over iterable, adding the time taken to produce each item
+        to the `name' stage."""
+        timer = self.timers[name]
+        iterator = iter(iterable)
+        clock = time.time
+        while True:
+            start = clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                timer[1] += clock() - start
+                return
+            timer[0] += 1
+            timer[1] += clock() - start
+            yield item
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def count_code(self, code, n=1):
+        self.codes[code] += n
+
+    def instrument_codecs(self):
+        """Time every codec in registry.CODECS under "decode:<codec name>".
+
+        The codecs are wrapped in place, so this affects every store read
+        afterwards in this process.
+        """
+        wrapped = {}
+        for code, codec in list(registry.CODECS.items()):
+            if isinstance(codec, _TimedCodec):
+                codec = codec.codec
+            if codec not in wrapped:
+                wrapped[codec] = _TimedCodec(self, codec)
+            registry.CODECS[code] = wrapped[codec]
+
+    def merge(self, other):
+        """Add the stats of another Stats, or of its as_dict()."""
+        if isinstance(other, Stats):
+            other = other.as_dict()
+        for name, timer in other[u"stages"].items():
+            self.add_time(name, timer[u"seconds"], timer[u"calls"])
+        for name, n in other[u"counters"].items():
+            self.counters[name] += n
+        for code, n in other[u"records_per_code"].items():
+            self.codes[code] += n
+
+    def reset(self):
+        self.timers.clear()
+        self.counters.clear()
+        self.codes.clear()
+
+    def as_dict(self):
+        return collections.OrderedDict([
+            (u"elapsed", time.time() - self.started),
+            (u"stages", collections.OrderedDict(
+                (name, collections.OrderedDict([
+                    (u"calls", calls),
+                    (u"seconds", seconds),
+                ]))
+                for name, (calls, seconds) in sorted(self.timers.items())
+            )),
+            (u"counters", collections.OrderedDict(sorted(self.counters.items()))),
+            (u"records_per_code", collections.OrderedDict(sorted(self.codes.items()))),
+        ])
+
+    def progress(self):
+        """One line summing up the run so far."""
+        elapsed = time.time() - self.started
+        files = self.counters[u"files_parsed"] + self.counters[u"files_failed"]
+        return u"[{0:.0f}s] {1} files ({2} failed), {3} records, {4:.1f} files/s".format(
+            elapsed,
+            files,
+            self.counters[u"files_failed"],
+            self.counters[u"records"],
+            files / elapsed if elapsed else 0.0
+        )
+
+
+class _Timer(object):
+    __slots__ = ("stats", "name", "start")
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats.add_time(self.name, time.time() - self.start)
+
+
+class _TimedCodec(object):
+    """A codec that times its decode calls. Keeps the codec's __name__, so
+    records report the same type."""
+    def __init__(self, stats, codec):
+        self.stats = stats
+        self.codec = codec
+        self.__name__ = codec.__name__
+        self.name = u"decode:" + codec.__name__
+
+    def decode(self, data):
+        start = time.time()
+        try:
+            return self.codec.decode(data)
+        finally:
+            self.stats.add_time(self.name, time.time() - start)
+
+
+class CountingFile(object):
+    """Wraps a file object, counting the bytes read through it."""
+    def __init__(self, file_io):
+        self._file_io = file_io
+        self.bytes_read = 0
+
+    def read(self, *args):
+        data = self._file_io.read(*args)
+        self.bytes_read += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._file_io, name)
@@ -19,8 +19,12 @@ setup(
     zip_safe=False,
     include_package_data=True,
     install_requires=[
-        'mac_alias'
+        'mac_alias',
+        'scandir; python_version < "3.5"'
     ],
+    extras_require={
+        'columnar': ['numpy'],
+    },
     packages=find_packages(
         '.'
     ),
@@ -1,10 +1,40 @@
+import io
 import os
+import sys
+import json
+import time
+import pickle
+import shutil
+import struct
+import sqlite3
+import tarfile
+import zipfile
+import tempfile
 import unittest
+import collections
 from ds_store_parser import ds_store_handler
+from ds_store_parser.ds_store import DSStore, DSStoreEntry, EntryFilter, CycleError
+from ds_store_parser import report, sinks, columnar, registry, decoders
+from ds_store_parser.stats import Stats
+from ds_store_parser.cache import ParseCache, ContentDedup, DecodeCache
+from ds_store_parser import discovery
+from ds_store_parser.discovery import Discovery
+from ds_store_parser.archive import ArchiveDiscovery, MemberStat, is_archive
+from ds_store_parser.carve import CarveDiscovery
+from ds_store_parser.readahead import ReadAhead
+import DSStoreParser
 
 TEST_STORE_001 = "../.testdata/.DS_Store"
 
 
+class _ListSink(sinks.RecordSink):
+    def __init__(self):
+        self.rows = []
+
+    def write_rows(self, rows):
+        self.rows.extend(rows)
+
+
 class TestStoreParser(unittest.TestCase):
     def test_parser(self):
         with open(TEST_STORE_001, "rb") as fh:
@@ -25,5 +55,725 @@ class TestStoreParser(unittest.TestCase):
             self.assertEqual(entry_dict['code'], u"moDD")
             self.assertEqual(entry_dict['value'].isoformat(" "), "2017-09-12 22:03:23")
 
+    def test_structured_codecs(self):
+        with open(TEST_STORE_001, "rb") as fh:
+            handler = ds_store_handler.DsStoreHandler(fh, TEST_STORE_001)
+            records = [record.as_tuple() for record in handler]
+
+        iloc = records[2][3]
+        self.assertEqual((iloc.x, iloc.y, iloc.index), (472, 152, None))
+        self.assertEqual(
+            unicode(iloc), u"Location: (472, 152), Selected Index: Null, Unknown: ffff0000"
+        )
+        dilc = records[1][3]
+        self.assertEqual((dilc.grid_quadrant, dilc.icon_pos_x), (2, 4294967237))
+        self.assertEqual(
+            report.render_value(u"dilc", dilc),
+            u"Desktop Icon Location Changed: (Unk1: 00000000, GridQuadrant: 2, "
+            u"Unk2: 5040, IconPosFromRight: 58, IconPosFromBottom: 289, "
+            u"GridIconPosFromLeft: 94076, GridIconPosFromTop: 63795, "
+            u"Unk3: ffffffff, Unk4: ffff0000)"
+        )
+        self.assertEqual(sinks.to_json(iloc)[u"unknown"], u"ffff0000")
+
+        # A value of a plugin's own is labelled with its field names
+        class PairValue(decoders.StructuredValue,
+                        collections.namedtuple("PairValue", ("count", "flags"))):
+            __slots__ = ()
+            hex_fields = ("flags",)
+        self.assertEqual(unicode(PairValue(3, b"\x00\xff")), u"(count: 3, flags: 00ff)")
+
+    def test_parser_mapped(self):
+        with open(TEST_STORE_001, "rb") as fh:
+            handler = ds_store_handler.DsStoreHandler(
+                fh, TEST_STORE_001, mapped=True
+            )
+            records = [record.as_dict() for record in handler]
+
+        with open(TEST_STORE_001, "rb") as fh:
+            handler = ds_store_handler.DsStoreHandler(
+                fh, TEST_STORE_001
+            )
+            expected = [record.as_dict() for record in handler]
+
+        self.assertEqual(records, expected)
+
+    def test_parser_no_decode(self):
+        with open(TEST_STORE_001, "rb") as fh:
+            handler = ds_store_handler.DsStoreHandler(
+                fh, TEST_STORE_001, decode=False
+            )
+            records = [record.as_dict() for record in handler]
+
+        self.assertEqual(len(records), 53)
+        self.assertEqual(records[0]['code'], u"Iloc")
+        self.assertEqual(records[0]['type'], u"blob")
+        self.assertEqual(records[0]['value'], b"000001d80000002800000009ffff0000")
+
+        # The store only decodes with the codecs it is given
+        with open(TEST_STORE_001, "rb") as fh:
+            iloc = [entry for entry in DSStore.open(fh, "rb")
+                    if entry.code == b"Iloc"][0]
+            self.assertEqual((iloc.type, iloc.value[:4]), (b"blob", b"\0\0\1\xd8"))
+            fh.seek(0)
+            iloc = [entry for entry in DSStore.open(fh, "rb", codecs=registry.CODECS)
+                    if entry.code == b"Iloc"][0]
+            self.assertEqual((iloc.value.x, iloc.value.y), (472, 40))
+
+    def test_batches(self):
+        with open(TEST_STORE_001, "rb") as fh:
+            handler = ds_store_handler.DsStoreHandler(fh, TEST_STORE_001)
+            expected = [record.as_tuple() for record in handler]
+
+            numpy = columnar.numpy
+            try:
+                for columnar.numpy in set([numpy, None]):
+                    batches = list(handler.batches(size=20))
+                    self.assertEqual([len(batch) for batch in batches], [20, 20, 13])
+                    records = []
+                    for batch in batches:
+                        records.extend(batch.as_tuples())
+                    self.assertEqual(records, expected)
+            finally:
+                columnar.numpy = numpy
+
+        batch = batches[1]
+        # Record 33, the moDD of M1-Test-Shared_Folder_Desktop
+        row = 13
+        self.assertEqual(batch.code[row], b"moDD")
+        self.assertTrue(batch.has_timestamp[row])
+        self.assertEqual(
+            columnar.to_datetime(batch.timestamp[row]).isoformat(" "),
+            "2017-09-12 22:03:23"
+        )
+        self.assertIsNone(batch.value[row])
+
+    def test_registry(self):
+        class SizeCodec(object):
+            @staticmethod
+            def decode(data):
+                return len(data)
+
+        self.assertEqual(report.category(u"Iloc"), report.OTHER_INFO)
+        self.assertIsNone(report.category(u"xxxx"))
+        original = registry.CODES[b"Iloc"]
+        try:
+            registry.register(u"Iloc", registry.FOLDER_ACCESS, b"blob",
+                              SizeCodec, u"Site Iloc: ")
+            self.assertEqual(report.category(u"Iloc"), report.FOLDER_ACCESS)
+            with open(TEST_STORE_001, "rb") as fh:
+                handler = ds_store_handler.DsStoreHandler(fh, TEST_STORE_001)
+                records = [record.as_tuple() for record in handler
+                           if record.ds_store_entry.code == b"Iloc"]
+        finally:
+            registry.register(*original)
+
+        self.assertTrue(records)
+        self.assertEqual(set(r[1:] for r in records), set([(u"SizeCodec", b"Iloc", 16)]))
+        self.assertEqual(report.render_value(u"Iloc", 16), u"Icon Location or Index Changed: 16")
+
+    def test_parser_filter(self):
+        with open(TEST_STORE_001, "rb") as fh:
+            handler = ds_store_handler.DsStoreHandler(
+                fh, TEST_STORE_001,
+                entry_filter=EntryFilter(codes=[u"moDD", u"vSrn"], prefix=u"M1")
+            )
+            records = [record.as_dict() for record in handler]
+
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]['filename'], u"M1-Test-Shared_Folder_Desktop")
+        self.assertEqual(records[0]['code'], u"moDD")
+        self.assertEqual(records[0]['value'].isoformat(" "), "2017-09-12 22:03:23")
+        self.assertEqual(records[1]['code'], u"vSrn")
+
+        with open(TEST_STORE_001, "rb") as fh:
+            store = DSStore.open(fh, "rb")
+            self.assertEqual([entry.key for entry in store.filter()],
+                             [entry.key for entry in store])
+
+    def test_lookup(self):
+        with open(TEST_STORE_001, "rb") as fh:
+            store = DSStore.open(fh, "rb")
+            keys = [entry.key for entry in store]
+
+            self.assertEqual(store[u"M1-Test-Shared_Folder_Desktop"][u"moDD"],
+                             (b"dutc", 235149630046208))
+            self.assertEqual(
+                [entry.key for entry in store.find(u"m1-test-shared_folder_desktop")],
+                [key for key in keys if key[0] == u"m1-test-shared_folder_desktop"]
+            )
+            self.assertIsNone(store.get(u"logs", u"zzzz"))
+            self.assertRaises(KeyError, lambda: store[u"logs"][u"zzzz"])
+            self.assertEqual(
+                [entry.key for entry in store.range(u"f", u"m")],
+                [key for key in keys if u"f" <= key[0] < u"m"]
+            )
+
+    def test_block_cache(self):
+        with open(TEST_STORE_001, "rb") as fh:
+            store = DSStore.open(fh, "rb", decode=False)
+            first = [entry.key for entry in store]
+            misses = store.cache.misses
+            second = [entry.key for entry in store]
+            self.assertEqual(store.cache.misses, misses)
+            self.assertEqual(store[u"M1-Test-Shared_Folder_Desktop"][u"moDD"],
+                             (b"dutc", 235149630046208))
+            self.assertEqual(store.cache.misses, misses)
+            self.assertTrue(store.cache.hits)
+
+        self.assertEqual(second, first)
+        with open(TEST_STORE_001, "rb") as fh:
+            # Room for one 4096 byte node only
+            store = DSStore.open(fh, "rb", decode=False, cache_bytes=4096)
+            self.assertEqual([entry.key for entry in store], first)
+            self.assertTrue(store.cache.evictions)
+            self.assertTrue(store.cache.size <= 4096)
+        with open(TEST_STORE_001, "rb") as fh:
+            self.assertIsNone(DSStore.open(fh, "rb", cache_bytes=0).cache)
+
+    def test_read_records(self):
+        with open(TEST_STORE_001, "rb") as fh:
+            store = DSStore.open(fh, "rb")
+            # Blocks 2 and 4 are the leaves of the test store
+            for number in (2, 4):
+                block = store._get_block(number)
+                count = block.read(b">II")[1]
+                start = block.tell()
+                entries = DSStoreEntry.read_records(block, count)
+                end = block.tell()
+
+                block.seek(start)
+                expected = [DSStoreEntry.read(block) for n in range(count)]
+                self.assertEqual(block.tell(), end)
+                self.assertEqual(
+                    [(e.filename, e.code, e.type, e.value) for e in entries],
+                    [(e.filename, e.code, e.type, e.value) for e in expected]
+                )
+
+                # A block over a memoryview, as mapped stores give on
+                # Python 3, is read in place
+                block._value = memoryview(bytes(block._value))
+                block.seek(start)
+                entries = DSStoreEntry.read_records(block, count)
+                self.assertEqual(block.tell(), end)
+                self.assertEqual(
+                    [(e.filename, e.code, e.type, e.value) for e in entries],
+                    [(e.filename, e.code, e.type, e.value) for e in expected]
+                )
+
+    def test_cycle(self):
+        with open(TEST_STORE_001, "rb") as fh:
+            data = bytearray(fh.read())
+
+        # Point the root node's rightmost child back at the root itself
+        struct.pack_into(">I", data, 132, 3)
+        store = DSStore.open(io.BytesIO(bytes(data)), "rb")
+
+        with self.assertRaises(CycleError) as context:
+            list(store)
+        self.assertEqual(context.exception.node, 3)
+        self.assertEqual(context.exception.parent, 3)
+
+    def test_from_entries(self):
+        with open(TEST_STORE_001, "rb") as fh:
+            entries = list(DSStore.open(fh, "rb"))
+            expected = [
+                record.as_dict()
+                for record in ds_store_handler.DsStoreHandler(fh, TEST_STORE_001)
+            ]
+
+        # A small page size gives a multi-level tree
+        data = io.BytesIO()
+        store = DSStore.from_entries(data, entries, page_size=512)
+        self.assertGreater(store._levels, 1)
+        self.assertEqual(len(list(store)), 53)
+        self.assertEqual(store.get(u"M1-Test-Shared_Folder_Desktop", u"moDD").value,
+                         entries[33].value)
+
+        handler = ds_store_handler.DsStoreHandler(io.BytesIO(data.getvalue()), "")
+        self.assertEqual([record.as_dict() for record in handler], expected)
+
+        with self.assertRaises(ValueError):
+            DSStore.from_entries(io.BytesIO(), entries[::-1])
+
+    def test_stats(self):
+        stats = Stats()
+        self.assertEqual(list(stats.timed(u"traverse", range(3))), [0, 1, 2])
+        with stats.timer(u"allocator"):
+            pass
+        stats.count(u"files_parsed")
+        stats.count_code(u"Iloc", 2)
+
+        total = Stats()
+        total.merge(stats.as_dict())
+        total.merge(stats)
+        summary = total.as_dict()
+        self.assertEqual(summary[u"stages"][u"traverse"][u"calls"], 6)
+        self.assertEqual(summary[u"stages"][u"allocator"][u"calls"], 2)
+        self.assertEqual(summary[u"counters"][u"files_parsed"], 2)
+        self.assertEqual(summary[u"records_per_code"][u"Iloc"], 4)
+
+    def test_parse_cache(self):
+        rows = self._report_rows()
+        stat_result = os.stat(TEST_STORE_001)
+        outdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(outdir, "cache.db")
+            cache = ParseCache(path)
+            key = cache.key(TEST_STORE_001, stat_result)
+            self.assertIsNone(cache.get(key))
+            cache.put(key, rows)
+            cache.close()
+
+            cache = ParseCache(path)
+            records = cache.get(key)
+            self.assertIsNone(cache.get(cache.key(
+                TEST_STORE_001, stat_result, {'decode': False}
+            )))
+            # Records rendered with other codes registered are not reused
+            original = registry.CODES[b"Iloc"]
+            try:
+                registry.register(u"Iloc", registry.FOLDER_ACCESS, b"blob",
+                                  None, u"Site Iloc: ")
+                other = ParseCache(path)
+                self.assertIsNone(other.get(other.key(TEST_STORE_001, stat_result)))
+                other.close()
+            finally:
+                registry.register(*original)
+            cache.close()
+
+            # A new version drops the old entries
+            cache = ParseCache(path, version=u"next")
+            self.assertIsNone(cache.get(key))
+            cache.close()
+        finally:
+            shutil.rmtree(outdir)
+
+        self.assertEqual(len(records), 53)
+        self.assertEqual(
+            [report.render_value(code, value) for filename, record_type, code, value in records],
+            [report.render_value(row.code, row.value) for row in rows]
+        )
+
+    def test_content_dedup(self):
+        rows = self._report_rows()
+        outdir = tempfile.mkdtemp()
+        try:
+            paths = []
+            for name in ("a", "b", "c"):
+                path = os.path.join(outdir, name)
+                shutil.copyfile(TEST_STORE_001, path)
+                paths.append(path)
+            with open(paths[2], "ab") as fh:
+                fh.write(b"\0")
+
+            dedup = ContentDedup()
+            first_key, duplicate = dedup.key(paths[0], os.stat(paths[0]))
+            self.assertFalse(duplicate)
+            # The first file is only hashed once another has its size
+            key, duplicate = dedup.key(paths[1], os.stat(paths[1]))
+            self.assertTrue(duplicate)
+            self.assertFalse(dedup.key(paths[2], os.stat(paths[2]))[1])
+
+            dedup.put(first_key, rows)
+            records, error = dedup.take(key)
+
+            # Room for one file's records: once the first file's are
+            # dropped, a copy of it is parsed rather than waiting for
+            # records that are gone
+            dedup = ContentDedup(max_bytes=dedup.size)
+            first_key = dedup.key(paths[0], os.stat(paths[0]))[0]
+            dedup.put(first_key, rows)
+            other_key = dedup.key(paths[2], os.stat(paths[2]))[0]
+            dedup.put(other_key, rows)
+            self.assertEqual(dedup.size, dedup.max_bytes)
+            key, duplicate = dedup.key(paths[1], os.stat(paths[1]))
+            self.assertFalse(duplicate)
+            dedup.put(key, rows)
+            shutil.copyfile(TEST_STORE_001, os.path.join(outdir, "d"))
+            path = os.path.join(outdir, "d")
+            key, duplicate = dedup.key(path, os.stat(path))
+            self.assertTrue(duplicate)
+            self.assertEqual(len(dedup.take(key)[0]), 53)
+
+            # Records a duplicate waits for are dropped too when nothing
+            # else is left to drop; it is then parsed itself
+            shutil.copyfile(paths[2], path)
+            dedup = ContentDedup(max_bytes=dedup.max_bytes)
+            first_keys = []
+            keys = []
+            for original, copy in ((paths[0], paths[1]), (paths[2], path)):
+                first_keys.append(dedup.key(original, os.stat(original))[0])
+                key, duplicate = dedup.key(copy, os.stat(copy))
+                self.assertTrue(duplicate)
+                keys.append(key)
+            for first_key in first_keys:
+                dedup.put(first_key, rows)
+            self.assertIsNone(dedup.take(keys[0]))
+            self.assertEqual(len(dedup.take(keys[1])[0]), 53)
+
+            sink = _ListSink()
+            record_handler = DSStoreParser.RecordHandler(
+                [sink], dedup=ContentDedup(max_bytes=1)
+            )
+            for path in paths[:2]:
+                DSStoreParser.parse(path, record_handler, outdir)
+            self.assertEqual(len(sink.rows), 2 * 53)
+        finally:
+            shutil.rmtree(outdir)
+
+        self.assertIsNone(error)
+        self.assertEqual(len(records), 53)
+
+    def test_decode_cache(self):
+        def plists():
+            with open(TEST_STORE_001, "rb") as fh:
+                handler = ds_store_handler.DsStoreHandler(fh, TEST_STORE_001)
+                return [record.as_tuple() for record in handler
+                        if record.as_tuple()[1] == u"PlistCodec"]
+
+        expected = plists()
+        decode_cache = DecodeCache()
+        decode_cache.install()
+        try:
+            first = plists()
+            second = plists()
+        finally:
+            decode_cache.uninstall()
+        self.assertEqual(first, expected)
+        self.assertEqual(second, expected)
+        self.assertEqual(decode_cache.misses, len(decode_cache))
+        self.assertEqual(decode_cache.hits, 2 * len(expected) - len(decode_cache))
+        # Every record got the same read-only value, rendered as the
+        # decoded value itself is
+        value = second[0][3]
+        self.assertIs(value, first[0][3])
+        self.assertEqual([unicode(r[3]) for r in second],
+                         [unicode(r[3]) for r in expected])
+        nested = [item for record in second for item in record[3].values()
+                  if hasattr(item, "keys")]
+        self.assertTrue(nested)
+        for frozen in (value, nested[0]):
+            with self.assertRaises(TypeError):
+                frozen[u"x"] = 1
+        self.assertEqual(sinks.to_json(value), sinks.to_json(expected[0][3]))
+
+        decode_cache = DecodeCache(max_entries=1)
+        decode_cache.install()
+        try:
+            evicted = plists()
+        finally:
+            decode_cache.uninstall()
+        self.assertEqual(evicted, expected)
+        self.assertEqual(len(decode_cache), 1)
+        self.assertEqual(decode_cache.evictions, decode_cache.misses - 1)
+        self.assertNotIn(u"_CachedCodec", repr(registry.CODECS.values()))
+
+    def test_discovery(self):
+        source = tempfile.mkdtemp()
+        try:
+            for folder in (u"a", u"a/x", u"b", u"b/c", u"skip", u"d"):
+                os.makedirs(os.path.join(source, folder))
+            for folder in (u"", u"a", u"a/x", u"b/c", u"skip", u"d"):
+                shutil.copyfile(
+                    TEST_STORE_001, os.path.join(source, folder, u".DS_Store")
+                )
+            with open(os.path.join(source, u"b", u"notes.txt"), "wb") as fh:
+                fh.write(b"x")
+            # A hard link is the same file under a second path
+            os.link(os.path.join(source, u"a", u".DS_Store"),
+                    os.path.join(source, u"b", u".DS_Store"))
+
+            expected = []
+            for root, dirnames, filenames in os.walk(source):
+                for filename in filenames:
+                    if filename == u".DS_Store":
+                        expected.append(os.path.join(root, filename))
+            linked = os.path.join(source, u"b", u".DS_Store")
+            if expected.index(linked) < expected.index(
+                    os.path.join(source, u"a", u".DS_Store")):
+                linked = os.path.join(source, u"a", u".DS_Store")
+            expected.remove(linked)
+
+            found = [path for path, stat_result in Discovery(source)]
+            # The name pattern prunes skip, the full path pattern only b/c
+            excludes = [u"skip", os.path.join(u"*", u"b", u"c")]
+            pruned = [path for path, stat_result
+                      in Discovery(source, excludes=excludes)]
+
+            # The same directory again under another name, as a bind mount
+            # would show it
+            scandir = discovery.scandir
+            scanned = []
+            def aliased(directory):
+                scanned.append(directory)
+                entries = list(scandir(directory))
+                if directory == source:
+                    entries += [entry for entry in entries if entry.name == u"d"]
+                return entries
+            try:
+                discovery.scandir = aliased
+                aliased_found = [path for path, s in Discovery(source)]
+                # The os.walk fallback, when there is no scandir
+                discovery.scandir = None
+                walked = [path for path, s in Discovery(source)]
+            finally:
+                discovery.scandir = scandir
+        finally:
+            shutil.rmtree(source)
+
+        self.assertEqual(found, expected)
+        self.assertEqual(walked, expected)
+        self.assertEqual(aliased_found, expected)
+        self.assertEqual(len(scanned), len(set(scanned)))
+        self.assertEqual(
+            pruned,
+            [path for path in expected
+             if os.sep + u"skip" + os.sep not in path
+             and os.sep + os.path.join(u"b", u"c") + os.sep not in path]
+        )
+        self.assertEqual(len(pruned), len(expected) - 2)
+
+    def test_archive_discovery(self):
+        outdir = tempfile.mkdtemp()
+        try:
+            tar_path = os.path.join(outdir, "evidence.tar.gz")
+            tar = tarfile.open(tar_path, "w:gz")
+            tar.add(TEST_STORE_001, "case/.DS_Store")
+            tar.add(TEST_STORE_001, "case/skip/.DS_Store")
+            tar.close()
+            zip_path = os.path.join(outdir, "evidence.zip")
+            archive = zipfile.ZipFile(zip_path, "w")
+            archive.write(TEST_STORE_001, "case/.DS_Store")
+            archive.close()
+
+            found = {}
+            for path in (tar_path, zip_path):
+                self.assertTrue(is_archive(path))
+                found[path] = list(ArchiveDiscovery(path, excludes=["skip"]))
+        finally:
+            shutil.rmtree(outdir)
+
+        for path, members in found.items():
+            self.assertEqual(len(members), 1)
+            ds_file, stat_result = members[0]
+            self.assertEqual(ds_file, os.path.join(path, "case", ".DS_Store"))
+            self.assertEqual(stat_result.st_size, os.stat(TEST_STORE_001).st_size)
+            handler = ds_store_handler.DsStoreHandler(
+                io.BytesIO(stat_result.data), ds_file
+            )
+            self.assertEqual(len(list(handler)), 53)
+        self.assertFalse(is_archive(TEST_STORE_001))
+
+    def test_carve(self):
+        with open(TEST_STORE_001, "rb") as fh:
+            data = fh.read()
+        # Block 4 is a leaf of the test store
+        addr = DSStore.open(io.BytesIO(data), "rb")._store._offsets[4]
+        start = 4 + (addr & ~0x1f)
+        page = data[start:start + 4096]
+
+        outdir = tempfile.mkdtemp()
+        try:
+            image = os.path.join(outdir, "unallocated.dd")
+            with open(image, "wb") as fh:
+                fh.write(b"\xa5" * 8192 + data)
+                fh.write(b"\xa5" * (-(fh.tell() - 4) % 512) + page + b"\xa5" * 5000)
+            # Chunks smaller than a page, so anchors straddle them
+            carved = list(CarveDiscovery(image, chunk_size=1000))
+            # Scanned once, on a pool of its own, before iterating
+            parallel = CarveDiscovery(image, chunk_size=1000, jobs=2)
+            hits = parallel.scan()
+            self.assertIs(parallel.scan(), hits)
+            self.assertEqual(
+                [(ds_file, stat_result.data) for ds_file, stat_result in parallel],
+                [(ds_file, stat_result.data) for ds_file, stat_result in carved]
+            )
+        finally:
+            shutil.rmtree(outdir)
+
+        self.assertEqual(
+            [os.path.basename(ds_file) for ds_file, stat_result in carved],
+            [u"0x2000.DS_Store", u"0x5804.leaf.DS_Store"]
+        )
+        records = []
+        for ds_file, stat_result in carved:
+            handler = ds_store_handler.DsStoreHandler(
+                io.BytesIO(stat_result.data), ds_file
+            )
+            records.append([record.as_tuple() for record in handler])
+        self.assertEqual(carved[0][1].st_size, len(data))
+        self.assertEqual(len(records[0]), 53)
+        self.assertEqual(carved[1][1].st_size, 4096)
+        self.assertEqual(len(records[1]), 25)
+        for record in records[1]:
+            self.assertIn(record, records[0])
+
+    def test_read_ahead(self):
+        missing = os.path.join(tempfile.gettempdir(), "missing.DS_Store")
+        stat_result = os.stat(TEST_STORE_001)
+        files = [(TEST_STORE_001, stat_result), (missing, stat_result)] * 3
+
+        # A limit below one file's size still lets each file through
+        read = list(ReadAhead(files, threads=2, max_bytes=1))
+
+        self.assertEqual([path for path, loaded in read], [path for path, s in files])
+        with open(TEST_STORE_001, "rb") as fh:
+            data = fh.read()
+        for path, loaded in read:
+            if path == missing:
+                self.assertIs(loaded, stat_result)
+            else:
+                self.assertEqual(loaded.data, data)
+                self.assertEqual(loaded.st_size, stat_result.st_size)
+                self.assertEqual(loaded.st_mtime, stat_result.st_mtime)
+
+        # Entries that carry their data count against the limit too, so
+        # an archive is not drained into memory ahead of the parser
+        produced = []
+        def members():
+            for index in range(10):
+                produced.append(index)
+                yield (u"member%d" % index, MemberStat(len(data), None, data=data))
+        reader = iter(ReadAhead(members(), threads=2, max_bytes=1))
+        next(reader)
+        time.sleep(0.2)
+        self.assertLessEqual(len(produced), 3)
+        self.assertEqual(len(list(reader)), 9)
+
+        # The parser reports a file that cannot be read as its error
+        for stats in (None, Stats()):
+            record_handler = DSStoreParser.RecordHandler(stats=stats)
+            rows, error = DSStoreParser.parse_rows(
+                missing, record_handler, tempfile.gettempdir(), stat_result
+            )
+            self.assertEqual(rows, [])
+            self.assertIn("No such file", error)
+
+    def _run_main(self, *args):
+        argv = sys.argv
+        sys.argv = ["DSStoreParser.py"] + list(args)
+        try:
+            DSStoreParser.main()
+        finally:
+            sys.argv = argv
+
+    def _reports(self, outdir):
+        reports = {}
+        for name in sorted(os.listdir(outdir)):
+            with open(os.path.join(outdir, name), "rb") as fh:
+                reports[name] = fh.read()
+        return reports
+
+    def test_jobs_match_serial(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            source = os.path.join(tempdir, u"case")
+            now = time.time()
+            for folder in (u"a", u"b", u"b/c", u"d"):
+                os.makedirs(os.path.join(source, folder))
+                path = os.path.join(source, folder, u".DS_Store")
+                shutil.copyfile(TEST_STORE_001, path)
+                # An access time ahead of the others, which reading the
+                # file leaves alone, so both runs report the same times
+                os.utime(path, (now + 3600, now - 60))
+            reports = []
+            for jobs in (u"1", u"2"):
+                outdir = os.path.join(tempdir, u"out" + jobs)
+                os.mkdir(outdir)
+                self._run_main(u"-s", source, u"-o", outdir, u"-j", jobs)
+                reports.append(self._reports(outdir))
+        finally:
+            shutil.rmtree(tempdir)
+
+        self.assertEqual(len(reports[0]), 3)
+        self.assertEqual(reports[1], reports[0])
+        self.assertEqual(
+            reports[0]["DS_Store-All_Parsed_Report.tsv"].count(b"\n"), 4 * 53 + 1
+        )
+
+    def _report_rows(self):
+        with open(TEST_STORE_001, "rb") as fh:
+            handler = ds_store_handler.DsStoreHandler(fh, TEST_STORE_001)
+            rows = []
+            for record in handler:
+                filename, record_type, code, value = record.as_tuple()
+                rows.append(report.ReportRow(
+                    filename, filename, value, record_type, code,
+                    0, u"", u"", u"", u"", TEST_STORE_001
+                ))
+        return rows
+
+    def test_jsonl_sink(self):
+        rows = self._report_rows()
+        outdir = tempfile.mkdtemp()
+        try:
+            sink = sinks.JsonLinesSink(outdir)
+            sink.write_rows(rows)
+            sink.close()
+            with open(os.path.join(outdir, sinks.ALL_RECORDS_JSONL), "rb") as fh:
+                records = [json.loads(line) for line in fh]
+        finally:
+            shutil.rmtree(outdir)
+
+        self.assertEqual(len(records), 53)
+        self.assertEqual(records[0]['code'], u"Iloc")
+        self.assertEqual(records[0]['description'], u"Icon Location or Index Changed")
+        self.assertTrue(any(isinstance(r['value'], dict) for r in records))
+
+    def test_rendered_values(self):
+        row = self._report_rows()[0]
+        full = report.rendered(row.code, row.value)
+        text_only = report.rendered(row.code, row.value, keep_value=False)
+        self.assertEqual(text_only, full)
+        self.assertIsNone(text_only.value)
+        # Rows replayed from a cache are not rendered twice
+        self.assertIs(report.rendered(row.code, full), full)
+        self.assertIsNone(report.rendered(row.code, full, keep_value=False).value)
+
+        copy = pickle.loads(pickle.dumps(full, 2))
+        self.assertEqual(copy, full)
+        self.assertEqual(sinks.to_json(copy.value), sinks.to_json(row.value))
+
+    def test_sqlite_sink(self):
+        rows = self._report_rows()
+        outdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(outdir, "records.db")
+            db = sqlite3.connect(path)
+            db.execute("CREATE TABLE notes (note TEXT)")
+            db.execute("INSERT INTO notes VALUES ('kept')")
+            db.commit()
+            db.close()
+            # A second run replaces the records of the first
+            for run in range(2):
+                sink = sinks.SqliteSink(path, batch_size=10)
+                sink.write_rows(rows)
+                sink.close()
+
+            db = sqlite3.connect(path)
+            notes = db.execute("SELECT note FROM notes").fetchall()
+            count, = db.execute("SELECT COUNT(*) FROM all_records").fetchone()
+            other, = db.execute("SELECT COUNT(*) FROM other_info").fetchone()
+            moDD = db.execute(
+                "SELECT value FROM all_records WHERE code = 'moDD'"
+                " AND filename = 'M1-Test-Shared_Folder_Desktop'"
+            ).fetchone()
+            db.close()
+        finally:
+            shutil.rmtree(outdir)
+
+        self.assertEqual(count, 53)
+        self.assertEqual(
+            other,
+            len([r for r in rows if report.category(r.code) == report.OTHER_INFO])
+        )
+        self.assertEqual(moDD, (u"Modified date gathered: 2017-09-12 22:03:23",))
+        self.assertEqual(notes, [(u"kept",)])
+
+        class Incomplete(sinks.RecordSink):
+            pass
+        self.assertRaises(TypeError, Incomplete)
+
 if __name__ == '__main__':
     unittest.main()